@@ -0,0 +1,57 @@
+import sys
+sys.path.insert(0, "cdkk")
+import cdkk
+
+# Headless check of images shared through asset_cache: sprites loaded from the same
+# file share one surface until one of them draws on it (after make_writable()), and
+# must not see each other's drawing, or the drawing of sprites made earlier
+
+# --------------------------------------------------
+
+
+class AssetCacheApp(cdkk.PyGameApp):
+    def init(self):
+        super().init()
+        self.results = {}
+        ball_a = cdkk.Sprite("A")
+        ball_a.load_image_from_file("beachball.png")
+        ball_b = cdkk.Sprite("B")
+        ball_b.load_image_from_file("beachball.png")
+        before = ball_b.image.get_at((0, 0))
+        self.results["shared"] = ball_a.image is ball_b.image
+
+        ball_a.make_writable().fill("red")
+        ball_c = cdkk.Sprite("C")
+        ball_c.load_image_from_file("beachball.png")
+
+        stats = cdkk.asset_cache.stats
+        self.results["loads"] = (stats["hits"], stats["misses"])
+        self.results["A"] = ball_a.image.get_at((0, 0))
+        self.results["B"] = (before, ball_b.image.get_at((0, 0)))
+        self.results["C"] = ball_c.image.get_at((0, 0))
+        self.results["still shared"] = (ball_a.image is not ball_b.image) and (ball_b.image is ball_c.image)
+
+    def update(self):
+        super().update()
+        self.exit_app()
+
+# --------------------------------------------------
+
+
+app_config = {
+    "headless": True,
+    "caption": "Test PyGame - Asset Cache",
+    "image_path": "cdkk\\TestSuite\\"
+}
+app = AssetCacheApp(app_config)
+app.execute()
+
+results = app.results
+before, after = results["B"]
+assert results["loads"] == (2, 1), "Expected one decode for three loads: {0}".format(results["loads"])
+assert results["shared"], "Sprites loaded from the same file don't share the image"
+assert results["still shared"], "Only the sprite drawn on should have its own image"
+assert results["A"] == (255, 0, 0, 255), "Drawing on sprite A didn't change it"
+assert after == before, "Drawing on sprite A changed sprite B"
+assert results["C"] == before, "Drawing on sprite A changed the cached image"
+print("Drawing on one sprite's image doesn't leak to other sprites")
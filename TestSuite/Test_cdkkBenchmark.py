@@ -0,0 +1,57 @@
+import sys
+sys.path.insert(0, "cdkk")
+import cdkk
+
+# Headless benchmark: no window is opened, so this can run in CI
+
+# --------------------------------------------------
+
+
+class Sprite_Ball(cdkk.Sprite_Shape):
+    def __init__(self, posx, posy, velx, vely, limits):
+        super().__init__(name="Ball", rect=cdkk.cdkkRect(posx, posy, 20, 20),
+                         style={"fillcolour": "red3", "outlinecolour": None, "shape": "Ellipse"})
+        self.rect.set_velocity(velx, vely)
+        self.rect.set_acceleration(0, self.rect.gravity)
+        self.rect.add_limit(cdkk.Physics_Limit(limits, cdkk.LIMIT_KEEP_INSIDE, cdkk.AT_LIMIT_BOUNCE))
+        self.rect.go()
+        self.set_config("auto_move_physics", True)
+
+# --------------------------------------------------
+
+
+class Manager_Balls(cdkk.SpriteManager):
+    def __init__(self, limits, num_balls, name="Ball Manager"):
+        super().__init__(name)
+        for i in range(num_balls):
+            self.add(Sprite_Ball(20 + (i * 37) % (limits.width - 40),
+                                 20 + (i * 53) % (limits.height - 40),
+                                 (i % 11) - 5, (i % 7) - 3, limits))
+
+# --------------------------------------------------
+
+
+class BenchmarkApp(cdkk.PyGameApp):
+    def init(self):
+        super().init()
+        self.add_sprite_mgr(Manager_Balls(self.boundary, 500))
+        self.add_sprite_mgr(cdkk.SM_Scoreboard())
+
+# --------------------------------------------------
+
+
+app_config = {
+    "width": 1200, "height": 800,
+    "background_fill": "burlywood",
+    "caption": "Test PyGame - Benchmark"
+}
+app = BenchmarkApp(app_config)
+report = app.benchmark(frames=500)
+assert not app.get_config("headless") and not app.get_config("profile"), "benchmark() didn't restore the config"
+phases = report.pop("phases")
+for key, value in report.items():
+    print("{0:12} {1}".format(key, value))
+for phase, owners in phases.items():
+    for owner, stats in owners.items():
+        print("{0:14} {1:20} mean={2:7.3f} p95={3:7.3f} p99={4:7.3f} msecs".format(
+            phase, owner, stats["mean_msecs"], stats["p95_msecs"], stats["p99_msecs"]))
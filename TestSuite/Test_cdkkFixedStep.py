@@ -0,0 +1,52 @@
+import sys
+sys.path.insert(0, "cdkk")
+import cdkk
+
+# Headless check of the fixed-timestep loop: every fixed step must see
+# game time one step on from the step before
+
+# --------------------------------------------------
+
+
+class Manager_Ticks(cdkk.SpriteManager):
+    def __init__(self, name="Tick Manager"):
+        super().__init__(name)
+        self.ticks = []
+
+    def update(self):
+        super().update()
+        self.ticks.append(cdkk.game_clock.get_ticks())
+
+# --------------------------------------------------
+
+
+class FixedStepApp(cdkk.PyGameApp):
+    def init(self):
+        super().init()
+        self.tick_mgr = Manager_Ticks()
+        self.add_sprite_mgr(self.tick_mgr)
+
+    def update(self):
+        super().update()
+        if self.loop_counter >= 20:
+            self.exit_app()
+
+# --------------------------------------------------
+
+
+app_config = {
+    "headless": True,
+    "virtual_frame_time": 50,
+    "fixed_update_time": 10,
+    "max_update_steps": 5,
+    "caption": "Test PyGame - Fixed Step"
+}
+app = FixedStepApp(app_config)
+app.use_virtual_clock()
+app.execute()
+
+ticks = app.tick_mgr.ticks
+steps = [t2 - t1 for t1, t2 in zip(ticks, ticks[1:])]
+assert len(ticks) > 20, "Expected several fixed steps per loop"
+assert all(s == 10 for s in steps), "Fixed steps don't advance game time by 10 msecs: {0}".format(steps)
+print("{0} fixed steps, each 10 msecs of game time".format(len(ticks)))
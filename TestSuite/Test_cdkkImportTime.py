@@ -0,0 +1,28 @@
+import sys
+import os
+import subprocess
+import time
+
+# Import-time benchmark: each import runs in a fresh interpreter
+
+# --------------------------------------------------
+
+imports = {
+    "python": "pass",
+    "import cdkk": "import cdkk",
+    "cdkk.BoardGame": "import cdkk; cdkk.BoardGame",
+    "cdkk.PyGameApp": "import cdkk; cdkk.PyGameApp",
+    "from cdkk import *": "from cdkk import *"
+}
+runs = 5
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+env = dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1")
+for desc, code in imports.items():
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=package_dir, env=env, check=True)
+        times.append((time.perf_counter() - start) * 1000.0)
+    times.sort()
+    print("{0:20} best={1:7.1f} median={2:7.1f} msecs".format(desc, times[0], times[runs // 2]))
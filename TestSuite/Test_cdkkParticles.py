@@ -0,0 +1,57 @@
+import sys
+sys.path.insert(0, "cdkk")
+import cdkk
+import pygame
+
+# Headless check of Sprite_Particles: an emitter made without a rect covers the
+# display, and emitted particles are drawn on it
+
+# --------------------------------------------------
+
+
+class Manager_Particles(cdkk.SpriteManager):
+    def __init__(self, name="Particle Manager"):
+        super().__init__(name)
+        self.emitter = cdkk.Sprite_Particles(style={"particlesize": 3})
+        self.add(self.emitter)
+
+# --------------------------------------------------
+
+
+class ParticlesApp(cdkk.PyGameApp):
+    def init(self):
+        super().init()
+        self.particle_mgr = Manager_Particles()
+        self.add_sprite_mgr(self.particle_mgr)
+        self.emitter_size = self.particle_mgr.emitter.image.get_size()
+        self.lit_pixels = 0
+
+    def update(self):
+        super().update()
+        if self.loop_counter == 1:
+            self.particle_mgr.emitter.emit(200, self.boundary.center, velocity=(0, -2), spread=(2, 2), colour="red1")
+
+    def draw(self, flip=True):
+        super().draw(flip)
+        if self.loop_counter >= 3:
+            pixels = pygame.surfarray.array2d(self.display_surface)
+            red = self.display_surface.map_rgb(cdkk.colours["red1"])
+            self.lit_pixels = int((pixels == red).sum())
+            self.exit_app()
+
+# --------------------------------------------------
+
+
+app_config = {
+    "headless": True,
+    "width": 400, "height": 300,
+    "virtual_frame_time": 20,
+    "background_fill": "black",
+    "caption": "Test PyGame - Particles"
+}
+app = ParticlesApp(app_config)
+app.execute()
+
+assert app.emitter_size == (400, 300), "The emitter doesn't cover the display: {0}".format(app.emitter_size)
+assert app.lit_pixels > 0, "No particles were drawn"
+print("{0} pixels drawn by particles".format(app.lit_pixels))
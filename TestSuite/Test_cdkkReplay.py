@@ -0,0 +1,60 @@
+import sys
+sys.path.insert(0, "cdkk")
+import os
+import random
+import tempfile
+import cdkk
+
+# Headless check of record and replay: a replayed session runs the same number of
+# updates as the recording and ends in the same state
+
+# --------------------------------------------------
+
+
+class Manager_Random(cdkk.SpriteManager):
+    def __init__(self, name="Random Manager"):
+        super().__init__(name)
+        self.updates = 0
+        self.values = []
+
+    def update(self):
+        super().update()
+        self.updates += 1
+        self.values.append(random.randint(0, 1000))
+
+# --------------------------------------------------
+
+
+class ReplayApp(cdkk.PyGameApp):
+    def init(self):
+        super().init()
+        self.random_mgr = Manager_Random()
+        self.add_sprite_mgr(self.random_mgr)
+
+    def update(self):
+        super().update()
+        if self.recording and self.loop_counter >= 17:
+            self.exit_app()
+
+# --------------------------------------------------
+
+
+log_file = os.path.join(tempfile.mkdtemp(), "replay.evt")
+app_config = {
+    "headless": True,
+    "virtual_frame_time": 20,
+    "caption": "Test PyGame - Replay"
+}
+
+recorded = ReplayApp(dict(app_config, record_file=log_file))
+recorded.execute()
+replayed = ReplayApp(dict(app_config, replay_file=log_file))
+replayed.execute()
+os.remove(log_file)
+
+rec_mgr = recorded.random_mgr
+rep_mgr = replayed.random_mgr
+assert rec_mgr.updates == 18, "Expected 18 recorded updates: {0}".format(rec_mgr.updates)
+assert rep_mgr.updates == rec_mgr.updates, "Replayed {0} updates, recorded {1}".format(rep_mgr.updates, rec_mgr.updates)
+assert rep_mgr.values == rec_mgr.values, "The replayed session didn't end in the recorded state"
+print("Replayed {0} updates, as recorded".format(rep_mgr.updates))
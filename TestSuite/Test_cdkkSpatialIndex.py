@@ -0,0 +1,119 @@
+import sys
+sys.path.insert(0, "cdkk")
+import cdkk
+import pygame
+
+# Headless check of the spatial index: a sprite that moves in update() and then
+# checks for collisions must find sprites that have already moved this frame, including
+# sprites moved by the manager's PhysicsWorld
+
+# --------------------------------------------------
+
+
+class Sprite_Mover(cdkk.Sprite):
+    def __init__(self, name, x, dx, sprite_mgr):
+        super().__init__(name)
+        self.image = pygame.Surface((10, 10))
+        self.rect = cdkk.cdkkRect(x, 0, 10, 10)
+        self.dx = dx
+        self.sprite_mgr = sprite_mgr
+        self.hits = None
+
+    def update(self):
+        super().update()
+        if self.hits is None:  # Move once, in the first frame
+            self.rect.left = self.rect.left + self.dx
+            self.hits = [s.name for s in self.collide(self.sprite_mgr, pygame.sprite.collide_rect) if s is not self]
+
+# --------------------------------------------------
+
+
+class Manager_Movers(cdkk.SpriteManager):
+    def __init__(self, name="Mover Manager"):
+        super().__init__(name)
+        self.target = Sprite_Mover("Target", 600, -300, self)
+        self.bullet = Sprite_Mover("Bullet", 0, 300, self)
+        self.add(self.target)
+        self.add(self.bullet)
+        self.spatial_index()
+
+
+
+class Sprite_Checker(cdkk.Sprite):
+    # Compares collide() with checking every sprite, each frame
+    def __init__(self, sprite_mgr):
+        super().__init__("Checker")
+        self.image = pygame.Surface((40, 40))
+        self.rect = cdkk.cdkkRect(300, 0, 40, 40)
+        self.sprite_mgr = sprite_mgr
+        self.mismatches = 0
+        self.hit_frames = 0
+
+    def update(self):
+        super().update()
+        hits = [s.name for s in self.collide(self.sprite_mgr, pygame.sprite.collide_rect) if s is not self]
+        expected = [s.name for s in self.sprite_mgr.sprites() if s is not self and s.rect.colliderect(self.rect)]
+        if hits != expected:
+            self.mismatches += 1
+        if expected:
+            self.hit_frames += 1
+
+# --------------------------------------------------
+
+
+class Manager_Physics(cdkk.SpriteManager):
+    def __init__(self, name="Physics Manager"):
+        super().__init__(name, physics_world=True)
+        target = cdkk.Sprite("Target")
+        target.image = pygame.Surface((10, 10))
+        target.rect.topleft = (0, 10)
+        target.rect.size = (10, 10)
+        target.rect.set_velocity(60, 0)
+        target.rect.go()
+        target.set_config("auto_move_physics", True)
+        self.checker = Sprite_Checker(self)
+        self.add(self.checker)  # Updated before the target
+        self.add(target)
+
+    def update(self):
+        self.sprites_near(self.checker.rect)  # A query before the bodies move this frame
+        super().update()
+
+# --------------------------------------------------
+
+
+class SpatialApp(cdkk.PyGameApp):
+    def init(self):
+        super().init()
+        self.mover_mgr = Manager_Movers()
+        self.add_sprite_mgr(self.mover_mgr)
+        self.physics_mgr = Manager_Physics()
+        self.add_sprite_mgr(self.physics_mgr)
+
+    def update(self):
+        super().update()
+        if self.loop_counter >= 60:
+            self.exit_app()
+
+# --------------------------------------------------
+
+
+app_config = {
+    "headless": True,
+    "virtual_frame_time": 50,
+    "caption": "Test PyGame - Spatial Index"
+}
+app = SpatialApp(app_config)
+app.use_virtual_clock()
+app.execute()
+
+mgr = app.mover_mgr
+assert mgr.bullet.rect.left == 300 and mgr.target.rect.left == 300, "Sprites didn't move"
+assert mgr.target.hits == [], "Target hit before the bullet moved: {0}".format(mgr.target.hits)
+assert mgr.bullet.hits == ["Target"], "Bullet missed the moved target: {0}".format(mgr.bullet.hits)
+print("Move-then-collide found the moved target")
+
+checker = app.physics_mgr.checker
+assert checker.hit_frames > 0, "The physics target never reached the checker"
+assert checker.mismatches == 0, "collide() missed sprites moved by physics in {0} frames".format(checker.mismatches)
+print("Collisions found sprites moved by physics in {0} frames".format(checker.hit_frames))
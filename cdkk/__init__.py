@@ -1,10 +1,74 @@
 club = "CoderDojo Kilkenny"
 
 import sys
-from cdkk.cdkkUtils import *
-from cdkk.cdkkColours import *
-from cdkk.cdkkSprite import *
-from cdkk.cdkkSpriteExtra import *
-from cdkk.cdkkSpriteManager import *
-from cdkk.cdkkPyGameApp import *
-from cdkk.cdkkBoardGame import *
+import importlib
+
+# Submodules are imported the first time one of their names is used, so
+# "import cdkk" is quick and e.g. cdkk.BoardGame doesn't import pygame.
+# Names are looked up in this order, the order they used to be star-imported.
+_submodules = ["cdkkUtils", "cdkkColours", "cdkkSprite", "cdkkSpriteExtra",
+               "cdkkSpriteManager", "cdkkPyGameApp", "cdkkBoardGame"]
+
+# Names that go straight to their submodule, without searching _submodules
+_lazy_names = {
+    "Board": "cdkkBoardGame",
+    "GameManager": "cdkkBoardGame",
+    "GameManagerMP": "cdkkBoardGame",
+    "BoardGame": "cdkkBoardGame",
+    "Direction": "cdkkBoardGame",
+    "Directions": "cdkkBoardGame",
+    "Style": "cdkkColours",
+    "Stylesheet": "cdkkColours",
+    "stylesheet": "cdkkColours",
+    "RGB": "cdkkColours",
+    "colours": "cdkkColours",
+    "cdkkApp": "cdkkApp",
+    "PyGameApp": "cdkkPyGameApp",
+}
+
+
+def _import_submodule(module_name):
+    module = importlib.import_module("cdkk." + module_name)
+    # Importing cdkk.cdkkApp sets cdkk.cdkkApp to the module; the name is the class
+    if "cdkk.cdkkApp" in sys.modules:
+        globals()["cdkkApp"] = sys.modules["cdkk.cdkkApp"].cdkkApp
+    return module
+
+
+def _all_names():
+    names = set()
+    for module_name in _submodules:
+        module = _import_submodule(module_name)
+        names.update(n for n in dir(module) if not n.startswith("_"))
+    return sorted(names)
+
+
+def __getattr__(name):
+    if name == "__all__":
+        # from cdkk import *
+        return _all_names()
+    if name.startswith("__"):
+        raise AttributeError(name)
+    if name in _submodules or name == "cdkkGameTemplate":
+        return _import_submodule(name)
+
+    module_names = _submodules
+    if name in _lazy_names:
+        module_names = [_lazy_names[name]]
+    for module_name in module_names:
+        module = _import_submodule(module_name)
+        if hasattr(module, name):
+            value = getattr(module, name)
+            globals()[name] = value
+            return value
+    raise AttributeError("module 'cdkk' has no attribute '{0}'".format(name))
+
+
+def __dir__():
+    # Only the names of submodules that have already been imported
+    names = set(globals()) | set(_lazy_names) | set(_submodules)
+    for module_name in _submodules:
+        module = sys.modules.get("cdkk." + module_name)
+        if module is not None:
+            names.update(n for n in dir(module) if not n.startswith("_"))
+    return sorted(names)
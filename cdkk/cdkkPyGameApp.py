@@ -1,5 +1,8 @@
 import pygame
 import os
+import time
+import math
+import random
 from cdkk.cdkkApp import *
 from cdkk.cdkkSprite import *
 
@@ -12,14 +15,28 @@ class PyGameApp(cdkkApp):
         "width": 1000,
         "height": 700,
         "full_screen": False,
+        "headless": False,       # Use the SDL dummy drivers; no window is opened
+        "virtual_frame_time": None,  # msecs or None; Advance game time by this each loop, uncapped
+        "time_scale": 1.0,       # Game time speed relative to real time
         "background_fill": None,
+        "dirty_rects": False,    # Only redraw and update areas that changed (see SpriteManager.find_dirty_rects)
         "frame_rate": 100,
         "slow_update_time": 321,  # msecs
+        "fixed_update_time": None,  # msecs or None; Fixed simulation step, e.g. 1000/60
+        "max_update_steps": 5,   # Max fixed steps per loop before dropping time
+        "max_frame_skip": 0,     # Max consecutive draws skipped when behind
+        "idle_mode": False,      # Wait for events when nothing is moving, animating or due
+        "idle_max_wait": 1000,   # msecs; Longest wait in idle_mode
         "scroll_time": None,     # msecs or None
         "key_repeat_time": None,  # msecs or None
         "joystick_name": None,
         "joystick_number": None,
-        "post_key_name": True    # Post K_keyname if not dealt_with
+        "post_key_name": True,   # Post K_keyname if not dealt_with
+        "asset_cache_size": 64,  # MB; Memory for loaded images shared between sprites (see AssetCache)
+        "frame_store_size": 64,  # MB; Memory for spritesheets and their frames (see FrameStore)
+        "record_file": None,     # Record all events to this file (see EventRecorder)
+        "replay_file": None,     # Replay events from this file as fast as possible
+        "profile": False         # Time each loop phase, see frame_stats()
     }
     default_key_map = {
         pygame.K_q: "Quit",
@@ -34,6 +51,8 @@ class PyGameApp(cdkkApp):
     def __init__(self, app_config=None):
         super().__init__(None)
         self._sprite_mgrs = {}
+        self._sprite_mgr_names = {}    # Key = name, Value = list of sprite managers
+        self._sprite_mgr_index = {}    # Key = config key, Value = {config value: set of sprite managers}
         self.display_surface = None
         self.event_mgr = EventManager()
         self._fast_keys = False
@@ -43,6 +62,22 @@ class PyGameApp(cdkkApp):
         self._slow_update_timer = None
         self._loop_timer = LoopTimer(20)
         self._scroll_timer = None
+        self._frame_msecs = 0
+        self._accumulator = 0
+        self._interpolation = 1.0
+        self._frames_skipped = 0
+        self._skip_draw = False
+        self._profiler = None
+        self._background = None
+        self._full_redraw = True
+        self._idle_event = None
+        self._recorder = None
+        self._replayer = None
+        self._virtual_clock = None
+        self._preloader = None
+        self._preload_msecs = None
+        self.scheduler = TimerWheel()
+        TimerWheel.active = self.scheduler
         self.update_config(merge_dicts(cdkkApp.default_config,
                                        PyGameApp.default_config, app_config))
         self._width = self.get_config("width")
@@ -62,10 +97,128 @@ class PyGameApp(cdkkApp):
     def loop_counter(self):
         return self._loop_timer.loops
 
+    @property
+    def is_idle(self):
+        if self._scroll_timer is not None or self._preloader is not None:
+            return False
+        for sm in self._sprite_mgrs:
+            if sm.pending_work:
+                return False
+        return True
+
+    @property
+    def profiler(self):
+        return self._profiler
+
+    def frame_stats(self, phase=None, sprite_mgr_name=None):
+        # With "profile" on: no args = summary of all phases;
+        # phase (and sprite manager) = FrameHistogram for that phase
+        if self._profiler is None:
+            return None
+        elif phase is None:
+            return self._profiler.summary
+        else:
+            sm = None if sprite_mgr_name is None else self.sprite_mgr(sprite_mgr_name)
+            return self._profiler.histogram(phase, sm)
+
+    @property
+    def interpolation(self):
+        # Fraction of a fixed step (0-1) between the last update and this draw
+        return self._interpolation
+
+    def set_config(self, attribute, new_value):
+        super().set_config(attribute, new_value)
+        if attribute == "profile":
+            self._profiler = FrameProfiler() if new_value else None
+        elif attribute == "time_scale":
+            game_clock.time_scale = new_value
+        elif attribute == "fixed_update_time":
+            game_clock.fixed_step = new_value
+        elif attribute == "asset_cache_size":
+            asset_cache.max_bytes = new_value * 1024 * 1024
+            asset_cache.trim()
+        elif attribute == "frame_store_size":
+            frame_store.max_bytes = new_value * 1024 * 1024
+            frame_store.trim()
+        elif attribute in ("background_fill", "dirty_rects"):
+            self._background = None
+            self._full_redraw = True
+
+    def set_background(self, background=None):
+        # Surface restored behind sprites in dirty_rects mode (None = background_fill)
+        self._background = background
+        self._full_redraw = True
+
+    def _call_sprite_mgr(self, phase, sm, sm_method, *args):
+        if self._profiler is None:
+            return sm_method(*args)
+        start = self._profiler.start()
+        ret = sm_method(*args)
+        self._profiler.stop(start, phase, sm)
+        return ret
+
+    @property
+    def recording(self):
+        return self._recorder is not None
+
+    @property
+    def replaying(self):
+        return self._replayer is not None
+
+    def start_recording(self, filename):
+        self.stop_recording()
+        self._recorder = EventRecorder(filename)
+        random.seed(self._recorder.seed)
+
+    def stop_recording(self):
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+
+    def start_replay(self, filename):
+        # Random calls are seeded as they were when recorded, and the
+        # recorded frame times drive a virtual game clock
+        self._replayer = EventReplayer(filename)
+        random.seed(self._replayer.seed)
+        self.use_virtual_clock()
+
+    def use_virtual_clock(self):
+        # Game time only advances once per loop (see manage_loop), so run uncapped
+        self._virtual_clock = VirtualClock()
+        game_clock.set_source(self._virtual_clock)
+        self.set_config("frame_rate", 0)
+        return self._virtual_clock
+
+    def preload_assets(self, manifest, max_msecs=10, workers=None):
+        # Load images and spritesheets in the background while the loop runs, e.g. behind
+        # SM_SplashScreen. Up to max_msecs per loop is spent finishing decoded images.
+        # AssetProgress and AssetsLoaded game control events report progress (see AssetPreloader)
+        self._preloader = AssetPreloader(manifest, workers).start()
+        self._preload_msecs = max_msecs
+        return self._preloader
+
+    def _seed_frame(self, frame):
+        # Reseed every frame so each frame's random calls are reproducible
+        if self._recorder is not None:
+            random.seed((self._recorder.seed << 32) + frame)
+        elif self._replayer is not None:
+            random.seed((self._replayer.seed << 32) + frame)
+
     def init(self):
+        if self.get_config("replay_file") is not None:
+            self.start_replay(self.get_config("replay_file"))
+        elif self.get_config("record_file") is not None:
+            self.start_recording(self.get_config("record_file"))
+        if self.get_config("virtual_frame_time") is not None and self._virtual_clock is None:
+            self.use_virtual_clock()
+        game_clock.per_frame = True
+        game_clock.sample()
         super().init()
+        if self.get_config("headless"):
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+            os.environ["SDL_AUDIODRIVER"] = "dummy"
         pygame.init()
-        if self.get_config("full_screen"):
+        if self.get_config("full_screen") and not self.get_config("headless"):
             display_modes = pygame.display.list_modes()
             self._width, self._height = display_modes[0]
             self._width = self._width - 2
@@ -92,18 +245,99 @@ class PyGameApp(cdkkApp):
     def add_sprite_mgr(self, sprite_mgr):
         sprite_mgr.set_config("cdkkApp", self)
         self._sprite_mgrs[sprite_mgr] = sprite_mgr
+        self._name_sprite_mgr(sprite_mgr)
+        for key, index in self._sprite_mgr_index.items():
+            self._index_sprite_mgr(index, sprite_mgr, sprite_mgr.get_config(key))
+
+    def remove_sprite_mgr(self, sprite_mgr):
+        if sprite_mgr not in self._sprite_mgrs:
+            return False
+        del self._sprite_mgrs[sprite_mgr]
+        self._unname_sprite_mgr(sprite_mgr, sprite_mgr.name)
+        for key, index in self._sprite_mgr_index.items():
+            self._unindex_sprite_mgr(index, sprite_mgr, sprite_mgr.get_config(key))
+        sprite_mgr.set_config("cdkkApp", None)
+        self._full_redraw = True
+        return True
+
+    def _name_sprite_mgr(self, sprite_mgr):
+        try:
+            self._sprite_mgr_names.setdefault(sprite_mgr.name, []).append(sprite_mgr)
+        except TypeError:
+            pass  # Unhashable names aren't indexed
+
+    def _unname_sprite_mgr(self, sprite_mgr, name):
+        try:
+            sm_list = self._sprite_mgr_names.get(name)
+        except TypeError:
+            return
+        if sm_list is not None and sprite_mgr in sm_list:
+            sm_list.remove(sprite_mgr)
+            if len(sm_list) == 0:
+                del self._sprite_mgr_names[name]
+
+    def sprite_mgr_renamed(self, sprite_mgr, old_name):
+        # Called when SpriteManager.name changes, to keep the name index up to date
+        if sprite_mgr in self._sprite_mgrs:
+            self._unname_sprite_mgr(sprite_mgr, old_name)
+            # In the order they were added, as sprite_mgr() returns the last one
+            try:
+                self._sprite_mgr_names[sprite_mgr.name] = [sm for sm in self._sprite_mgrs if sm.name == sprite_mgr.name]
+            except TypeError:
+                pass  # Unhashable names aren't indexed
+
+    def _index_sprite_mgr(self, index, sprite_mgr, value):
+        try:
+            index.setdefault(value, set()).add(sprite_mgr)
+        except TypeError:
+            pass  # Unhashable values aren't indexed
+
+    def _unindex_sprite_mgr(self, index, sprite_mgr, value):
+        try:
+            sm_set = index.get(value)
+        except TypeError:
+            return
+        if sm_set is not None:
+            sm_set.discard(sprite_mgr)
+            if len(sm_set) == 0:
+                del index[value]
+
+    def _sprite_mgr_config_index(self, key):
+        # Secondary indexes are built the first time a config key is used as a filter
+        if key not in self._sprite_mgr_index:
+            index = {}
+            for sm in self._sprite_mgrs:
+                self._index_sprite_mgr(index, sm, sm.get_config(key))
+            self._sprite_mgr_index[key] = index
+        return self._sprite_mgr_index[key]
+
+    def sprite_mgr_config_changed(self, sprite_mgr, attribute, old_value):
+        # Called by SpriteManager.set_config() to keep the indexes up to date
+        index = self._sprite_mgr_index.get(attribute)
+        if index is not None and sprite_mgr in self._sprite_mgrs:
+            self._unindex_sprite_mgr(index, sprite_mgr, old_value)
+            self._index_sprite_mgr(index, sprite_mgr, sprite_mgr.get_config(attribute))
 
     def sprite_mgr(self, name, **sm_config):
-        ret_sprite_mgr = None
-        for sm in self._sprite_mgrs:
-            if sm.name == name:
-                found = True
-                if len(sm_config) > 0:
-                    for key, value in sm_config.items():
-                        found = found and (sm.get_config(key) == value)
-                if found:
-                    ret_sprite_mgr = sm
-        return ret_sprite_mgr
+        # Returns the last sprite manager added with this name and config values
+        try:
+            candidates = self._sprite_mgr_names.get(name)
+        except TypeError:
+            candidates = [sm for sm in self._sprite_mgrs if sm.name == name] or None
+        if candidates is None:
+            return None
+        for sm in reversed(candidates):
+            found = True
+            for key, value in sm_config.items():
+                try:
+                    found = sm in self._sprite_mgr_config_index(key).get(value, ())
+                except TypeError:
+                    found = (sm.get_config(key) == value)
+                if not found:
+                    break
+            if found:
+                return sm
+        return None
 
     def sprite(self, sprite_mgr_name, sprite_name, **sm_config):
         sm = self.sprite_mgr(sprite_mgr_name, **sm_config)
@@ -125,6 +359,8 @@ class PyGameApp(cdkkApp):
     def event(self, e):
         dealt_with = False
         is_broadcast = EventManager.is_broadcast(e)
+        if self._recorder is not None:
+            self._recorder.record(self.loop_counter, e)
 
         if e.type == pygame.QUIT or (e.type == EVENT_GAME_CONTROL and e.action == "Quit"):
             self.exit_app()
@@ -143,7 +379,7 @@ class PyGameApp(cdkkApp):
         for sm in self._sprite_mgrs:
             if (not dealt_with) or is_broadcast:
                 # Ask each sprite manager to deal with the event
-                dealt_with = sm.event(e)
+                dealt_with = self._call_sprite_mgr("manage_events", sm, sm.event, e)
 
         if (not dealt_with) or is_broadcast:
             dealt_with = self.event_mgr.event(e, self._fast_keys)
@@ -164,36 +400,219 @@ class PyGameApp(cdkkApp):
             sm.end_game()
 
     def manage_events(self):
-        for event in EventManager.get():
+        start = self._profiler.start() if self._profiler is not None else None
+        frame = self.loop_counter
+        self._seed_frame(frame)
+        self.scheduler.advance(game_clock.get_ticks())
+        if self._preloader is not None and self._preloader.poll(self._preload_msecs):
+            self._preloader = None
+        events = EventManager.get()
+        if self._idle_event is not None:
+            events.insert(0, self._idle_event)
+            self._idle_event = None
+        if self._replayer is not None:
+            # Only the recorded events are used, but the window can still be closed
+            events = self._replayer.events(frame) + [e for e in events if e.type == pygame.QUIT]
+            if self._replayer.finished(frame):
+                self.exit_app()
+        for event in events:
             self.event(event)
+        if start is not None:
+            self._profiler.stop(start, "manage_events")
+
+    def update_sprite_mgrs(self):
+        for sm in self._sprite_mgrs:
+            # Ask each sprite manager to update its sprites
+            self._call_sprite_mgr("update", sm, sm.update)
+
+    def _fixed_step_update(self):
+        # Run as many fixed steps as the time since the last loop allows
+        step = self.get_config("fixed_update_time")
+        max_steps = self.get_config("max_update_steps")
+        self._accumulator = self._accumulator + self._frame_msecs
+        steps = 0
+        while self._accumulator >= step and steps < max_steps:
+            # Each step sees game time one step on from the last
+            game_clock.advance(step)
+            self.update_sprite_mgrs()
+            self._accumulator = self._accumulator - step
+            steps = steps + 1
+
+        # If still behind, skip drawing to catch up or drop the excess time
+        behind = (self._accumulator >= step)
+        self._skip_draw = behind and self._frames_skipped < self.get_config("max_frame_skip")
+        if self._skip_draw:
+            self._frames_skipped = self._frames_skipped + 1
+        else:
+            self._frames_skipped = 0
+            if behind:
+                self._accumulator = self._accumulator % step
+        self._interpolation = min(self._accumulator / step, 1.0)
 
     def update(self):
+        start = self._profiler.start() if self._profiler is not None else None
         super().update()
-        for sm in self._sprite_mgrs:
-            sm.update()  # Ask each sprite manager to update its sprites
+        if self.get_config("fixed_update_time") is None:
+            self.update_sprite_mgrs()
+        else:
+            self._fixed_step_update()
+        if start is not None:
+            self._profiler.stop(start, "update")
 
         if self._slow_update_timer.time_left == 0:
+            start = self._profiler.start() if self._profiler is not None else None
             for sm in self._sprite_mgrs:
-                sm.slow_update()
+                self._call_sprite_mgr("slow_update", sm, sm.slow_update)
             self._slow_update_timer.start()
+            if start is not None:
+                self._profiler.stop(start, "slow_update")
+
+    def _draw_dirty(self):
+        if self._background is None:
+            self._background = pygame.Surface(self._size).convert()
+            fill = self.get_config("background_fill")
+            self._background.fill(colours[fill if fill is not None else "black"])
+            self._full_redraw = True
+
+        dirty_rects = []
+        for sm in self._sprite_mgrs:
+            dirty_rects.extend(self._call_sprite_mgr("draw", sm, sm.find_dirty_rects))
+
+        screen = self.display_surface.get_rect()
+        if self._full_redraw:
+            dirty_rects = [screen]
+            self._full_redraw = False
+        else:
+            dirty_rects = [r.clip(screen) for r in merge_rects(dirty_rects)]
+
+        for r in dirty_rects:
+            self.display_surface.blit(self._background, r, r)
+        for sm in self._sprite_mgrs:
+            self._call_sprite_mgr("draw", sm, sm.draw_dirty, self.display_surface, dirty_rects)
+        return dirty_rects
 
     def draw(self, flip=True):
+        if self._skip_draw:
+            return
+        start = self._profiler.start() if self._profiler is not None else None
         super().draw()
-        if self.get_config("background_fill") is not None:
-            self.display_surface.fill(
-                colours[self.get_config("background_fill")])
-        for sm in self._sprite_mgrs:
-            # Ask each sprite manager to draw its sprites
-            sm.draw(self.display_surface)
+        dirty_rects = None
+        if self.get_config("dirty_rects"):
+            dirty_rects = self._draw_dirty()
+        else:
+            if self.get_config("background_fill") is not None:
+                self.display_surface.fill(
+                    colours[self.get_config("background_fill")])
+            for sm in self._sprite_mgrs:
+                # Ask each sprite manager to draw its sprites
+                self._call_sprite_mgr("draw", sm, sm.draw, self.display_surface)
+        if start is not None:
+            self._profiler.stop(start, "draw")
         if flip:
-            pygame.display.flip()
+            start = self._profiler.start() if self._profiler is not None else None
+            if dirty_rects is None:
+                pygame.display.flip()
+            else:
+                pygame.display.update(dirty_rects)
+            if start is not None:
+                self._profiler.stop(start, "flip")
 
     def manage_loop(self):
+        # Set frame_rate to 0 to draw as fast as possible
         self._clock.tick(self.get_config("frame_rate"))
-        self._loop_timer.append()
+        if self._replayer is not None:
+            self._virtual_clock.advance(self._replayer.frame_msecs(self.loop_counter))
+        elif self._virtual_clock is not None:
+            self._virtual_clock.advance(self.get_config("virtual_frame_time", 0))
+        self._frame_msecs = game_clock.sample()
+        if self._recorder is not None:
+            self._recorder.record_frame_time(self.loop_counter, game_clock.source_msecs)
+        self._loop_timer.append(self._frame_msecs)
+        if self._profiler is not None:
+            self._profiler.end_frame()
+        if self.get_config("idle_mode") and self._game_status < 8 and self._virtual_clock is None and self.is_idle:
+            self.wait_for_event()
+
+    def wait_for_event(self):
+        # Block until an event arrives or the next Timer is due
+        wait = self.get_config("idle_max_wait")
+        next_due = Timer.next_due_msecs()
+        wheel_due = self.scheduler.next_due_msecs()
+        if wheel_due is not None:
+            next_due = wheel_due if next_due is None else min(next_due, wheel_due)
+        if next_due is not None and not game_clock.paused and game_clock.time_scale > 0:
+            wait = min(wait, next_due / game_clock.time_scale)
+        wait = int(math.ceil(wait))
+        if wait > 0:
+            e = pygame.event.wait(wait)
+            if e.type != pygame.NOEVENT:
+                self._idle_event = e
+
+    def benchmark(self, frames=None, secs=None):
+        # Run the game loop headless and uncapped for a number of frames and/or
+        # seconds (default 1000 frames) and return a report of the frame times
+        if frames is None and secs is None:
+            frames = 1000
+        # The config and SDL drivers changed here are put back afterwards
+        saved_config = {key: self.get_config(key) for key in ("headless", "frame_rate", "profile", "idle_mode")}
+        saved_env = {key: os.environ.get(key) for key in ("SDL_VIDEODRIVER", "SDL_AUDIODRIVER")}
+        self.set_config("headless", True)
+        self.set_config("frame_rate", 0)
+        self.set_config("profile", True)
+        # Measure throughput, not time spent waiting for events
+        self.set_config("idle_mode", False)
+
+        try:
+            if self.init() == False:
+                self._game_status = 8
+            else:
+                self.start_game()
+            self._profiler.clear()
+
+            num_frames = 0
+            bench_start = time.perf_counter()
+            while self._game_status < 8:
+                if frames is not None and num_frames >= frames:
+                    break
+                if secs is not None and (time.perf_counter() - bench_start) >= secs:
+                    break
+                self.manage_events()
+                self.update()
+                self.draw()
+                self.manage_loop()
+                num_frames = num_frames + 1
+            bench_secs = time.perf_counter() - bench_start
+
+            self.cleanup()
+            profiler = self._profiler
+        finally:
+            for key, value in saved_config.items():
+                self.set_config(key, value)
+            for key, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+        report = {
+            "frames": num_frames,
+            "secs": bench_secs,
+            "fps": num_frames / bench_secs if bench_secs > 0 else 0
+        }
+        frame_hist = profiler.histogram("frame")
+        if frame_hist is not None:
+            report.update(frame_hist.summary)
+        report["phases"] = profiler.summary
+        return report
 
     def cleanup(self):
+        self.stop_recording()
+        game_clock.per_frame = False
+        game_clock.set_source()
         for sm in self._sprite_mgrs:
             sm.cleanup()
+        frame_store.clear()
+        text_cache.clear()
+        font_cache.clear()
         pygame.quit()
         super().cleanup()
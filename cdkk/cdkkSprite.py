@@ -3,13 +3,13 @@
 # To Do: msecs_per_image not implemented
 # To Do: Change find_collisions to use SpriteGroup.collide()
 # To Do: Delete Sprite_DynamicText
-# To Do: Modify _load_image_from_file to use cdkkImage. Delete?
 # To Do: Delete load_animation???
 # To Do: Move SpriteManager to cdkkSpriteManager
 
 import pygame
 import pygame.gfxdraw
 import uuid
+import itertools
 from math import sin, cos
 from cdkk.cdkkUtils import *
 from cdkk.cdkkColours import *
@@ -17,7 +17,8 @@ from cdkk.cdkkColours import *
 sprite_styles = {
     "Shape": {"fillcolour": "white", "outlinecolour": "black", "outlinewidth": 3,
               "altcolour": "black", "highlightcolour": "yellow", "shape": "Rectangle",
-              "xpos": None, "ypos": None, "width": None, "height": None, "invisible": False},
+              "xpos": None, "ypos": None, "width": None, "height": None, "invisible": False,
+              "nineslice": None, "nineslicemargins": (8, 8, 8, 8)},
     "Invisible": {"fillcolour": None, "outlinecolour": None, "textsize": 36},
     "TextBox": {"textcolour": "black", "textsize": 36, "align_horiz": "C", "align_vert": "M", "textformat": "{0}"}
 }
@@ -25,6 +26,40 @@ stylesheet.add_stylesheet(sprite_styles)
 
 # stylesheet.style("Shape")
 
+def collide_filter(sprite):
+    # (category, mask) for a sprite: config "collide_category" and "collide_mask",
+    # otherwise style "collidecategory" and "collidemask"
+    if not hasattr(sprite, "get_config"):
+        return (COLLIDE_DEFAULT, COLLIDE_ALL)
+    category = sprite.get_config("collide_category")
+    if category is None:
+        category = sprite.get_style("collidecategory", COLLIDE_DEFAULT)
+    mask = sprite.get_config("collide_mask")
+    if mask is None:
+        mask = sprite.get_style("collidemask", COLLIDE_ALL)
+    return (category, mask)
+
+def can_collide(filter1, filter2):
+    return (filter1[0] & filter2[1]) != 0 and (filter2[0] & filter1[1]) != 0
+
+def collided_if_allowed(collided, *sprite_groups):
+    # Wrap a collided function (see pygame.sprite.spritecollide) so it first skips
+    # pairs whose collision categories and masks don't match
+    filters = {}
+    for group in sprite_groups:
+        for s in group:
+            filters[s] = collide_filter(s)
+    if all(f == (COLLIDE_DEFAULT, COLLIDE_ALL) for f in filters.values()):
+        return collided
+    if collided is None:
+        collided = pygame.sprite.collide_rect
+
+    def collided_filtered(sprite1, sprite2):
+        f1 = filters.get(sprite1) or collide_filter(sprite1)
+        f2 = filters.get(sprite2) or collide_filter(sprite2)
+        return can_collide(f1, f2) and collided(sprite1, sprite2)
+    return collided_filtered
+
 class Sprite(pygame.sprite.Sprite):
     DRAW_AS_REQD = 0
     DRAW_ALWAYS = 1
@@ -38,6 +73,7 @@ class Sprite(pygame.sprite.Sprite):
         self.set_config("uuid", uuid.uuid4())        
         self.rect = MovingRect()
         self._image = cdkkImage()
+        self._mask = None
         self.event_on_click = None
         self.event_on_unclick = None
         self._draw_reqd = False
@@ -54,6 +90,8 @@ class Sprite(pygame.sprite.Sprite):
 
     def set_config(self, attribute, value):
         self._desc[attribute] = value
+        if attribute == "auto_move_physics" and hasattr(self, "rect"):
+            self.rect.physics_changed()
 
     def get_style(self, attribute, default=None):
         return self._style.get(attribute, default)
@@ -105,6 +143,13 @@ class Sprite(pygame.sprite.Sprite):
     def game_is_active(self):
         return self._game_active
 
+    @property
+    def pending_work(self):
+        # True if the sprite needs the game loop to keep running (see PyGameApp "idle_mode")
+        if self._draw_reqd:
+            return True
+        return self.get_config("auto_move_physics", False) and self.rect.use_physics and not self.rect.stopped
+
     @property
     def image(self):
         return self._image.surface
@@ -114,6 +159,29 @@ class Sprite(pygame.sprite.Sprite):
         self._image.surface = new_image
         self._draw_reqd = True
 
+    @property
+    def mask(self):
+        # The mask set by create_mask_anim() (or assigned), otherwise the current image's
+        # mask from mask_cache, which is built on the first collision test
+        if self._mask is not None:
+            return self._mask
+        return mask_cache.get(self.image)
+
+    @mask.setter
+    def mask(self, new_mask):
+        self._mask = new_mask
+
+    def image_changed(self):
+        # Call after drawing on the image in place, so its mask is rebuilt
+        mask_cache.invalidate(self.image)
+
+    def make_writable(self):
+        # Images loaded from files, spritesheets and atlases are shared with other sprites
+        # (see AssetCache). Call this before drawing on self.image directly: it copies a
+        # shared image the first time and returns the sprite's own surface to draw on
+        self._draw_reqd = True
+        return self._image.make_writable()
+
     def _image_size_to_rect(self):
         self.rect.width = self.image.get_rect().width
         self.rect.height = self.image.get_rect().height
@@ -123,21 +191,8 @@ class Sprite(pygame.sprite.Sprite):
         return self._image
 
     def _load_image_from_file(self, filename, crop=None, scale_to=None):
-        img = cdkkImage()
-        ret_image = image = pygame.image.load(
-            img.image_path(filename)).convert_alpha()
-        if crop is not None:
-            # Crop the imported image by ... crop[left, right, top, bottom]
-            crop_rect = image.get_rect()
-            crop_rect.width = crop_rect.width - crop[0] - crop[1]
-            crop_rect.left = crop[0]
-            crop_rect.height = crop_rect.height - crop[2] - crop[3]
-            crop_rect.top = crop[2]
-            ret_image = pygame.Surface(crop_rect.size, pygame.SRCALPHA)
-            ret_image.blit(image, (0, 0), crop_rect)
-        if scale_to is not None:
-            ret_image = pygame.transform.smoothscale(ret_image, scale_to)
-        return ret_image
+        # Crop by ... crop[left, right, top, bottom]; the image is shared through asset_cache
+        return asset_cache.load(cdkkImage().image_path(filename), crop=crop, scale_to=scale_to)
 
     def load_image(self):
         pass
@@ -154,10 +209,9 @@ class Sprite(pygame.sprite.Sprite):
             else:
                 scale_to = (w, h)
             
+        # create_mask is kept for compatibility: masks are built on first use (see mask)
         self._image.load(filename, img_process=img_process, crop=crop, scale_to=scale_to)
         self._image_size_to_rect()
-        if create_mask:
-            self.create_mask()
 
     def load_image_from_spritesheet(self, spritesheet_filename, cols, rows, sprite_number, img_process=None, crop=None, scale_to=None, create_mask=True):
         if scale_to == "style":
@@ -172,8 +226,11 @@ class Sprite(pygame.sprite.Sprite):
         img.set_spritesheet(spritesheet_filename, cols, rows, img_process, crop=crop, scale_to=scale_to)
         self.image = img.spritesheet_image(sprite_number)
         self._image_size_to_rect()
-        if create_mask:
-            self.create_mask()
+
+    def load_image_from_region(self, region):
+        # Use an image packed in a TextureAtlas (an AtlasRegion); it is shared, not copied
+        self.image = region.surface
+        self._image_size_to_rect()
 
     def create_surface(self, width=None, height=None, per_pixel_alpha=True):
         # logger.debug("create_surface()")
@@ -187,6 +244,9 @@ class Sprite(pygame.sprite.Sprite):
             return pygame.Surface((width, height)).convert()
 
     def add_image(self, image, dest=(0, 0)):
+        self._draw_reqd = True
+        self._image.make_writable()
+        self.image_changed()
         return self.image.blit(image, dest)
 
     def process_image(self, commands_values, **kwargs):
@@ -206,14 +266,24 @@ class Sprite(pygame.sprite.Sprite):
         self.event_on_unclick = event_on_unclick
 
     def create_mask(self):
-        self.mask = pygame.mask.from_surface(self.image)
+        # Build the current image's mask now rather than on the first collision test,
+        # dropping any cached mask in case the image was redrawn in place
+        self._mask = None
+        mask_cache.invalidate(self.image)
+        mask_cache.get(self.image)
 
     def collide(self, sprite_group, collided=pygame.sprite.collide_mask):
+        if hasattr(sprite_group, "sprites_near") and collided in (pygame.sprite.collide_mask, pygame.sprite.collide_rect, None):
+            # These only collide when the rects overlap, so use the manager's spatial index
+            near = [s for s in sprite_group.sprites_near(self.rect) if s.image is not None]
+            return pygame.sprite.spritecollide(self, near, dokill=False, collided=collided_if_allowed(collided, [self], near))
+
         group2 = SpriteGroup("temp")
         for s in sprite_group:
             if s.image is not None:
                 group2.add(s)
 
+        collided = collided_if_allowed(collided, [self], group2)
         return pygame.sprite.spritecollide(self, group2, dokill=False, collided=collided)
 
     def draw(self, draw_flag=DRAW_AS_REQD, clear_draw_reqd=True):
@@ -225,7 +295,207 @@ class Sprite(pygame.sprite.Sprite):
 
     def update(self):
         super().update()
-        if self.get_config("auto_move_physics", False):
+        if self.get_config("auto_move_physics", False) and self.rect.physics_world is None:
+            self.rect.move_physics()
+
+    def slow_update(self):
+        pass
+
+    def start_game(self):
+        self._game_active = True
+
+    def end_game(self):
+        self._game_active = False
+
+# --------------------------------------------------
+
+
+class Sprite_Lite():
+    # Lightweight sprite for very large numbers of simple sprites, e.g. bullets or tiles.
+    # Keeps the Sprite draw/update contract, but uses __slots__, sequential ids instead
+    # of uuids, shares the image and style it is given (style is copied on first change)
+    # and only creates a MovingRect when use_physics() is called.
+    # It isn't a pygame.sprite.Sprite, but sprite groups and SpriteManager accept it.
+    __slots__ = ("__weakref__", "_Sprite_Lite__g", "_layer", "_id", "_name", "_desc", "_style", "_own_style",
+                 "image", "rect", "_mask", "event_on_click", "event_on_unclick", "_draw_reqd", "_game_active")
+    _ids = itertools.count(1)
+    default_style = Style()
+
+    def __init__(self, name="", image=None, rect=None, style=None, *groups):
+        self.__g = None
+        self._id = next(Sprite_Lite._ids)
+        self._name = name
+        self._desc = None
+        self._style = Sprite_Lite.default_style if style is None else style
+        self._own_style = False
+        self.image = image
+        self._mask = None
+        if rect is None:
+            rect = (0, 0) + (image.get_size() if image is not None else (0, 0))
+        self.rect = cdkkRect(rect)
+        self.event_on_click = None
+        self.event_on_unclick = None
+        self._draw_reqd = True
+        self._game_active = None
+        if groups:
+            self.add(*groups)
+
+    def __repr__(self):
+        return "<{0} Sprite(in {1} groups)>".format(self.__class__.__name__, len(self.groups()))
+
+    # Sprite group protocol (see pygame.sprite.Sprite)
+    def add(self, *groups):
+        for g in groups:
+            if hasattr(g, "_spritegroup"):
+                if not g.has(self):
+                    g.add(self)
+            else:
+                self.add(*g)
+
+    def remove(self, *groups):
+        for g in groups:
+            if hasattr(g, "_spritegroup"):
+                if g.has(self):
+                    g.remove(self)
+            else:
+                self.remove(*g)
+
+    def add_internal(self, group):
+        if self.__g is None:
+            self.__g = [group]
+        elif group not in self.__g:
+            self.__g.append(group)
+
+    def remove_internal(self, group):
+        self.__g.remove(group)
+
+    def kill(self):
+        for g in self.groups():
+            g.remove_internal(self)
+        self.__g = None
+
+    def groups(self):
+        return [] if self.__g is None else list(self.__g)
+
+    def alive(self):
+        return bool(self.__g)
+
+    @property
+    def layer(self):
+        return self._layer
+
+    # Sprite contract
+    def get_config(self, attribute, no_value=None):
+        if attribute == "name":
+            return self._name
+        elif attribute == "uuid":
+            return self._id
+        elif attribute == "class":
+            return self.__class__.__name__
+        elif self._desc is None:
+            return no_value
+        else:
+            return self._desc.get(attribute, no_value)
+
+    def set_config(self, attribute, value):
+        if attribute == "name":
+            self._name = value
+        else:
+            if self._desc is None:
+                self._desc = {}
+            self._desc[attribute] = value
+            if attribute == "auto_move_physics":
+                if isinstance(self.rect, MovingRect):
+                    self.rect.physics_changed()
+                elif value:
+                    # As Sprite, which always has a MovingRect
+                    self.use_physics(True)
+
+    def get_style(self, attribute, default=None):
+        return self._style.get(attribute, default)
+
+    def get_style_colour(self, attribute, default=None):
+        return self._style.get_rgb(attribute, default)
+
+    def set_style(self, attribute, new_value):
+        if not self._own_style:
+            self._style = Style(self._style)
+            self._own_style = True
+        self._style[attribute] = new_value
+        self._draw_reqd = True
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def uuid(self):
+        return self._id
+
+    @property
+    def game_is_active(self):
+        return self._game_active
+
+    @property
+    def pending_work(self):
+        if self._draw_reqd:
+            return True
+        if not isinstance(self.rect, MovingRect):
+            return False
+        return self.get_config("auto_move_physics", False) and self.rect.use_physics and not self.rect.stopped
+
+    def use_physics(self, auto_move=True):
+        # Swap the rect for a MovingRect at the same position; returns it ready for
+        # set_velocity(), add_limit(), go(), etc
+        if not isinstance(self.rect, MovingRect):
+            moving_rect = MovingRect()
+            moving_rect.topleft = self.rect.topleft
+            moving_rect.size = self.rect.size
+            self.rect = moving_rect
+            for g in self.groups():
+                if getattr(g, "physics_world", None) is not None:
+                    g.physics_world.add_sprite(self)
+        self.set_config("auto_move_physics", auto_move)
+        return self.rect
+
+    @property
+    def mask(self):
+        # Sprites sharing an image share its mask (see Sprite.mask)
+        if self._mask is not None:
+            return self._mask
+        return mask_cache.get(self.image)
+
+    @mask.setter
+    def mask(self, new_mask):
+        self._mask = new_mask
+
+    def image_changed(self):
+        mask_cache.invalidate(self.image)
+
+    def make_writable(self):
+        # As Sprite.make_writable(): call before drawing on a shared image
+        if self.image is not None and asset_cache.is_shared(self.image):
+            self.image = self.image.copy()
+        self._draw_reqd = True
+        return self.image
+
+    def create_mask(self):
+        self._mask = None
+        mask_cache.invalidate(self.image)
+        mask_cache.get(self.image)
+
+    def collide(self, sprite_group, collided=pygame.sprite.collide_mask):
+        return Sprite.collide(self, sprite_group, collided)
+
+    def draw(self, draw_flag=Sprite.DRAW_AS_REQD, clear_draw_reqd=True):
+        if self.image is None:
+            self.image = pygame.Surface(self.rect.size, pygame.SRCALPHA)
+        if clear_draw_reqd:
+            self._draw_reqd = False
+
+    def update(self, *args, **kwargs):
+        if self._desc is not None and self._desc.get("auto_move_physics", False) and isinstance(self.rect, MovingRect) \
+                and self.rect.physics_world is None:
             self.rect.move_physics()
 
     def slow_update(self):
@@ -256,11 +526,8 @@ class Sprite_Animation(Sprite):
 
         self.image = self._animations[set_name][0]
         self._image_size_to_rect()
-        if create_mask:
-            self.create_mask()
 
     def load_spritesheet(self, set_name, spritesheet_filename, cols, rows, create_mask=True, set_anim=False, start=None, end=None, length=None, img_process=None):
-        self._animations[set_name] = []
         if start is None:
             start = 0
         if end is None:
@@ -269,19 +536,21 @@ class Sprite_Animation(Sprite):
             else:
                 end = start + length
 
-        spritesheet = cdkkImage()
-        spritesheet.set_spritesheet(spritesheet_filename, cols, rows, img_process=img_process)
-        for i in range(start, end):
-            self._animations[set_name].append(spritesheet.spritesheet_image(i))
+        self._animations[set_name] = frame_store.frames(cdkkImage().image_path(spritesheet_filename), cols, rows,
+                                                        img_process=img_process, start=start, end=end)
 
         self.image = self._animations[set_name][0]
         self._image_size_to_rect()
-        if create_mask:
-            self.create_mask()
 
         if set_anim:
             self.set_animation(set_name)
 
+    @property
+    def pending_work(self):
+        animating = (self._anim_name is not None and self._anim_config.total > 1 and
+                     self._anim_config.mode != ANIMATE_MANUAL and self._anim_config.step != 0)
+        return animating or super().pending_work
+
     def set_animation(self, new_animation, mode=ANIMATE_LOOP, loops_per_image=None):
         if self._anim_name != new_animation and new_animation in self._animations:
             self._anim_name = new_animation
@@ -300,24 +569,12 @@ class Sprite_Animation(Sprite):
             self._draw_reqd = False
 
     def create_mask_anim(self, using_animation, using_frame):
-        reset_animation = None
-        reset_frame = None
-
-        if self._anim_name != using_animation:
-            reset_animation = self._anim_name
-            reset_frame = self._anim_config.current_image
-            self._anim_name = using_animation
-            self._anim_config.current_image = using_frame
-        elif using_frame != self._anim_config.index:
-            reset_frame = self._anim_config.current_image
-            self._anim_config.current_image = using_frame
-
-        self.create_mask()
-
-        if reset_animation is not None:
-            self._anim_name = reset_animation
-        if reset_frame is not None:
-            self._anim_config.current_image = reset_frame
+        # Use one frame's mask for collisions whatever frame is showing; self.mask = None
+        # goes back to the mask of the current frame
+        if using_animation in self._animations:
+            self._mask = mask_cache.get(self._animations[using_animation][using_frame])
+        else:
+            logger.error("Sprite_Animation.create_mask_anim(): Unknown animation {0}".format(using_animation))
 
 # --------------------------------------------------
 
@@ -350,6 +607,14 @@ class Sprite_Shape(Sprite):
         self.set_style("invisible", new_invisible)
         self.draw(Sprite.DRAW_AFTER_CLEAR)
 
+    @property
+    def nineslice(self):
+        # NineSliceImage from style "nineslice" (filename) and "nineslicemargins" [left, right, top, bottom]
+        filename = self.get_style("nineslice")
+        if filename is None:
+            return None
+        return NineSliceImage.shared(filename, self.get_style("nineslicemargins"))
+
     def setup_polygon(self, pointlist):
         self._pointlist = pointlist.copy()
         self._draw_reqd = True
@@ -381,6 +646,8 @@ class Sprite_Shape(Sprite):
     def draw(self, draw_flag=Sprite.DRAW_AS_REQD, clear_draw_reqd=True):
         super().draw(draw_flag, clear_draw_reqd=False)
         if (self._draw_reqd or draw_flag > Sprite.DRAW_AS_REQD) and not self.invisible:
+            self._image.make_writable()
+            self.image_changed()
             draw_rect = self.rect.copy()
             draw_rect.topleft = (0, 0)
             fill_col = self.get_style_colour("fillcolour")
@@ -408,6 +675,11 @@ class Sprite_Shape(Sprite):
                         pygame.draw.polygon(
                             self.image, line_col, self._pointlist, self.get_style("outlinewidth"))
 
+            elif self.get_style("nineslice") is not None:
+                # Rectangle drawn with a NineSliceImage, style "nineslice" is its filename
+                self.image.fill((0, 0, 0, 0))
+                self.image.blit(self.nineslice.render(draw_rect.size), (0, 0))
+
             else:  # Rectangle
                 if (fill_col is not None):
                     pygame.draw.rect(self.image, fill_col, draw_rect)
@@ -443,6 +715,9 @@ class Sprite_TextBox(Sprite_Shape):
 
     @text.setter
     def text(self, new_text):
+        # Setting the same text again redraws it, unless config "skip_same_text" is True
+        if new_text == self._text and self.get_config("skip_same_text", False):
+            return
         self._text = new_text
         self._draw_reqd = True
 
@@ -473,24 +748,31 @@ class Sprite_TextBox(Sprite_Shape):
     @property
     def font(self):
         if self._font is None:
-            self._font = pygame.font.Font(None, self.get_style("textsize"))
+            self._font = font_cache.get(None, self.get_style("textsize"))
         return self._font
 
+    def _clear_image(self, width, height):
+        # Reuse the image if it is already the right size
+        if self.image is not None and self.image.get_size() == (width, height):
+            self._image.make_writable()
+            self.image.fill((0, 0, 0, 0))
+        else:
+            self.image = self.create_surface(width, height)
+
     def draw(self, draw_flag=Sprite.DRAW_AS_REQD, clear_draw_reqd=True):
         super().draw(draw_flag, clear_draw_reqd=False)
         if (self._draw_reqd or draw_flag > Sprite.DRAW_AS_REQD) and not self.invisible:
-            text_image = self.font.render(
-                self.text, True, self.get_style_colour("textcolour"))
+            text_image = text_cache.render(
+                self.font, self.text, self.get_style_colour("textcolour"), True)
             text_rect = text_image.get_rect()
 
             if self._auto_size:
-                self.image = self.create_surface(
-                    text_rect.width, text_rect.height)
+                self._clear_image(text_rect.width, text_rect.height)
                 self._image_size_to_rect()
                 super().draw(Sprite.DRAW_ALWAYS, clear_draw_reqd=False)
 
             if self.get_style("fillcolour") is None:
-                self.image = self.create_surface()
+                self._clear_image(self.rect.width, self.rect.height)
                 super().draw(Sprite.DRAW_ALWAYS, clear_draw_reqd=False)
 
             if self.get_style("align_horiz") == "L":
@@ -516,6 +798,7 @@ class Sprite_TextBox(Sprite_Shape):
 
 class SpriteGroup(pygame.sprite.LayeredUpdates):
     def collide(self, sprite_group, dokilla=False, dokillb=False, collided=pygame.sprite.collide_mask):
+        collided = collided_if_allowed(collided, self, sprite_group)
         coll_dict = pygame.sprite.groupcollide(
             self, sprite_group, dokilla, dokillb, collided)
         return coll_dict
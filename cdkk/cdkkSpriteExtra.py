@@ -8,7 +8,9 @@ sprite_extra_styles = {
     "GameOver": { "textcolour":"red3", "textsize":72, "fillcolour":"yellow1", "outlinecolour":"red3", "outlinewidth":5, "width":400, "height":100},
     "BoardGame_Board": {"fillcolour":"black", "outlinecolour":None, "altcolour":"white", "highlightcolour":"violetred1", "outlinewidth":3},
     "BoardGame_Piece": {"outlinecolour":None, "shape":"Ellipse", "piecemargin":20 },
-    "ImageGrid": {"fillcolour":"black"}
+    "ImageGrid": {"fillcolour":"black"},
+    "Particles": {"particlesize":1 },
+    "ProgressBar": {"fillcolour":"white", "outlinecolour":None, "height":8 }
 
 }
 stylesheet.add_stylesheet(sprite_extra_styles)
@@ -158,6 +160,7 @@ class Sprite_BoardGame_Board(Sprite_Grid):
                 line_w = self.get_style("outlinewidth")
                 if line_col is not None:
                     pygame.draw.rect(self.image, line_col, r, line_w)
+        self.image_changed()
 
     def highlight_cells(self, cell_list, highlight_on = True):
         for c in cell_list:
@@ -171,6 +174,8 @@ class Sprite_BoardGame_Board(Sprite_Grid):
             line_col = self.get_style_colour("outlinecolour")
             if (line_col != None):
                 pygame.draw.rect(self.image, line_col, r, self.get_style("outlinewidth"))
+        self.image_changed()
+        self._draw_reqd = True
 
 ### --------------------------------------------------
 
@@ -202,6 +207,7 @@ class Sprite_BoardGame_Piece(Sprite_Shape):
     def draw(self, draw_flag=Sprite.DRAW_AS_REQD):
         if self._draw_reqd or draw_flag:
             self._draw_reqd = False
+            self.image_changed()
             fill_col = self.get_style_colour("fillcolour")
             line_col = self.get_style_colour("outlinecolour")
             line_width = self.get_style("outlinewidth")
@@ -238,6 +244,8 @@ class Sprite_ImageGrid(Sprite_Grid):
                 img.spritesheet_image(sprites[i*self.cols+j])
                 r = self.cell_rect(j, i, True)
                 self.image.blit(img.surface, r)
+        self.image_changed()
+        self._draw_reqd = True
 
 ### --------------------------------------------------
 
@@ -290,3 +298,104 @@ class Sprite_ImageGridActor(Sprite_Animation, GridActor):
         self.image_dir = new_dir
 
 ### --------------------------------------------------
+
+class Sprite_Particles(Sprite):
+    # Particle emitter for large numbers of particles, which are held in numpy arrays.
+    # Positions are screen positions, velocity and acceleration use the Physics units
+    # (scaled by multiplier) and all particles move in one step per update().
+    # Particles are drawn as pixels or squares (particlesize) straight into a pixel array.
+    def __init__(self, name="Particles", rect=None, max_particles=10000, style=None):
+        super().__init__(name, style=merge_dicts(stylesheet.style("Particles"), style))
+        self.multiplier = 50
+        self._max_particles = max_particles
+        self._count = 0
+        if numpy is None:
+            logger.error("Sprite_Particles needs numpy")
+            self._arrays = None
+        else:
+            self._pos = numpy.zeros((max_particles, 2), numpy.float32)
+            self._vel = numpy.zeros((max_particles, 2), numpy.float32)
+            self._acc = numpy.zeros((max_particles, 2), numpy.float32)
+            self._life = numpy.zeros(max_particles, numpy.float32)
+            self._colour = numpy.zeros(max_particles, numpy.uint32)
+            self._arrays = [self._pos, self._vel, self._acc, self._life, self._colour]
+        if rect is None and pygame.display.get_surface() is not None:
+            # Particles can go anywhere on the display
+            rect = pygame.display.get_surface().get_rect()
+        if rect is not None:
+            self.rect.topleft = rect.topleft
+            self.rect.size = rect.size
+        self.image = self.create_surface()
+
+    @property
+    def particle_count(self):
+        return self._count
+
+    @property
+    def pending_work(self):
+        return self._count > 0 or super().pending_work
+
+    def emit(self, count, pos, velocity=(0, 0), spread=(1, 1), acceleration=(0, Physics.gravity), life=1.0, life_spread=0.0, colour="white"):
+        # Add up to count particles at pos. Each velocity is randomly varied by up to +/- spread
+        # and each life (secs) by up to +/- life_spread. Returns the number of particles added.
+        count = min(count, self._max_particles - self._count)
+        if self._arrays is None or count <= 0:
+            return 0
+        # Seeded from random, so the particles are repeatable when random is (e.g. replays)
+        rng = numpy.random.default_rng(random.getrandbits(64))
+        new = slice(self._count, self._count + count)
+        self._pos[new] = pos
+        self._vel[new] = numpy.asarray(velocity) + (rng.random((count, 2)) * 2 - 1) * numpy.asarray(spread)
+        self._acc[new] = acceleration
+        self._life[new] = life + (rng.random(count) * 2 - 1) * life_spread
+        rgb = colours[colour] if colour in colours else colour
+        self._colour[new] = self.image.map_rgb(rgb) & 0xFFFFFFFF
+        self._count = self._count + count
+        self._draw_reqd = True
+        return count
+
+    def clear(self):
+        self._count = 0
+        self._draw_reqd = True
+
+    def update(self):
+        super().update()
+        n = self._count
+        if n == 0:
+            return
+        secs = game_clock.step_msecs / 1000.0
+        vel = self._vel[:n]
+        acc = self._acc[:n]
+        self._pos[:n] += (vel * secs + 0.5 * acc * secs * secs) * self.multiplier
+        vel += acc * secs
+        life = self._life[:n]
+        life -= secs
+        alive = life > 0
+        if not alive.all():
+            # Move the live particles to the front of the arrays
+            k = int(numpy.count_nonzero(alive))
+            for a in self._arrays:
+                a[:k] = a[:n][alive]
+            self._count = k
+        self._draw_reqd = True
+
+    def draw(self, draw_flag=Sprite.DRAW_AS_REQD, clear_draw_reqd=True):
+        if self._draw_reqd or draw_flag != Sprite.DRAW_AS_REQD:
+            self.image.fill((0, 0, 0, 0))
+            n = self._count
+            if n > 0:
+                size = self.get_style("particlesize", 1)
+                xy = (self._pos[:n] - self.rect.topleft - size // 2).astype(numpy.int32)
+                w, h = self.image.get_size()
+                pixels = pygame.surfarray.pixels2d(self.image)
+                for dx in range(size):
+                    for dy in range(size):
+                        x = xy[:, 0] + dx
+                        y = xy[:, 1] + dy
+                        inside = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+                        pixels[x[inside], y[inside]] = self._colour[:n][inside]
+                del pixels  # Unlock the surface
+        if clear_draw_reqd:
+            self._draw_reqd = False
+
+### --------------------------------------------------
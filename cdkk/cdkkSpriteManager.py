@@ -11,6 +11,13 @@ class SpriteManager(pygame.sprite.LayeredUpdates):
         self.name = name
         self._game_active = False
 
+        self._drawn_images = {}
+        self._physics_world = None
+        self._spatial = None
+        self._spatial_order = {}
+        self._spatial_stamp = None
+        self._update_count = 0
+
         self._sm_config = {}
         for key, value in sm_config.items():
             self.set_config(key, value)
@@ -18,10 +25,29 @@ class SpriteManager(pygame.sprite.LayeredUpdates):
         if self.get_config("control_type") is None:
             self.set_config("control_type", CONTROL_KEYBOARD+CONTROL_MOUSE)
 
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, new_name):
+        old_name = getattr(self, "_name", None)
+        self._name = new_name
+        app = self.get_config("cdkkApp")
+        if app is not None and new_name != old_name:
+            app.sprite_mgr_renamed(self, old_name)
+
     @property
     def game_is_active(self):
         return self._game_active
 
+    @property
+    def pending_work(self):
+        for s in self.sprites():
+            if s.pending_work:
+                return True
+        return False
+
     @property
     def player(self):
         player = self.get_config("player")
@@ -49,7 +75,13 @@ class SpriteManager(pygame.sprite.LayeredUpdates):
             return default
 
     def set_config(self, attribute, value):
+        old_value = self._sm_config.get(attribute)
         self._sm_config[attribute] = value
+        if attribute == "physics_world":
+            self._use_physics_world(value)
+        app = self._sm_config.get("cdkkApp")
+        if app is not None and attribute != "cdkkApp":
+            app.sprite_mgr_config_changed(self, attribute, old_value)
 
     def get_app_config(self, attribute, default=None):
         app = self.get_config("cdkkApp", None)
@@ -68,11 +100,182 @@ class SpriteManager(pygame.sprite.LayeredUpdates):
         else:
             return None
 
+    @property
+    def interpolation(self):
+        # Use at draw time to blend between the last two fixed updates
+        app = self.get_config("cdkkApp", None)
+        if app is None:
+            return 1.0
+        else:
+            return app.interpolation
+
+    @property
+    def physics_world(self):
+        return self._physics_world
+
+    def _use_physics_world(self, use_world):
+        # Config "physics_world": step the physics of all sprites together (see PhysicsWorld)
+        if use_world and self._physics_world is None:
+            if numpy is None:
+                logger.warning("PhysicsWorld needs numpy; sprites will move themselves")
+                return
+            self._physics_world = PhysicsWorld()
+            for s in self.sprites():
+                self._physics_world.add_sprite(s)
+        elif not use_world and self._physics_world is not None:
+            self._physics_world.clear()
+            self._physics_world = None
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        if self._physics_world is not None:
+            self._physics_world.add_sprite(sprite)
+        if self._spatial is not None:
+            self._spatial.update(sprite, sprite.rect)
+            self._spatial_stamp = None
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        if self._physics_world is not None:
+            self._physics_world.remove_sprite(sprite)
+        if self._spatial is not None:
+            self._spatial.remove(sprite)
+
+    def update(self, *args, **kwargs):
+        if self._physics_world is not None:
+            self._physics_world.step()
+            self._spatial_stamp = None  # Bodies have moved
+        if self._spatial is None:
+            super().update(*args, **kwargs)
+        else:
+            # Re-bucket each sprite as soon as it has moved, so spatial queries made
+            # later in this pass (e.g. Sprite.collide()) see where it is now
+            index = self._spatial
+            for s in self.sprites():
+                s.update(*args, **kwargs)
+                index.update(s, s.rect)
+        self._update_count = self._update_count + 1
+
+    def spatial_index(self):
+        # SpatialHash of the sprites' rects (config "spatial_cell_size", default 64), created
+        # on first use. Sprites are all re-bucketed on the first query after each update(),
+        # and by update() as each one moves, so call refresh_spatial_index() after moving
+        # sprites elsewhere (e.g. in event()) before querying again.
+        if self._spatial is None:
+            self._spatial = SpatialHash(self.get_config("spatial_cell_size", 64))
+            self._spatial_stamp = None
+        stamp = self._update_count
+        if stamp != self._spatial_stamp:
+            self.refresh_spatial_index()
+            self._spatial_stamp = stamp
+        return self._spatial
+
+    def refresh_spatial_index(self):
+        if self._spatial is not None:
+            index = self._spatial
+            order = {}
+            for i, s in enumerate(self.sprites()):
+                index.update(s, s.rect)
+                order[s] = i
+            self._spatial_order = order
+
+    def sprites_near(self, rect):
+        # Sprites in the spatial index cells that rect overlaps, in sprites() order
+        near = self.spatial_index().query(rect)
+        order = self._spatial_order
+        return sorted(near, key=lambda s: order.get(s, len(order)))
+
+    # Spatial queries, using the spatial index. Each takes optional filters:
+    #   exclude - a sprite, or list of sprites, to leave out (e.g. the sprite asking)
+    #   desc    - sprite config values to match, e.g. name="Enemy"
+
+    def _spatial_match(self, s, exclude, desc):
+        if s is exclude or (isinstance(exclude, (list, tuple, set)) and s in exclude):
+            return False
+        for attr, value in desc.items():
+            if s.get_config(attr) != value:
+                return False
+        return True
+
+    def sprites_in_rect(self, rect, exclude=None, **desc):
+        # Sprites whose rects overlap rect, in sprites() order
+        rect = cdkkRect(rect)
+        return [s for s in self.sprites_near(rect)
+                if s.rect.colliderect(rect) and self._spatial_match(s, exclude, desc)]
+
+    def _centre_distances(self, sprites, pos, exclude, desc):
+        x, y = pos
+        found = []
+        for s in sprites:
+            if self._spatial_match(s, exclude, desc):
+                cx, cy = s.rect.center
+                found.append((math.hypot(cx - x, cy - y), s))
+        return found
+
+    def sprites_in_radius(self, pos, radius, exclude=None, **desc):
+        # Sprites with their centre within radius of pos, nearest first
+        x, y = pos
+        near = self.sprites_near(cdkkRect(x - radius, y - radius, 2 * radius + 1, 2 * radius + 1))
+        found = [(d, s) for d, s in self._centre_distances(near, pos, exclude, desc) if d <= radius]
+        return [s for d, s in sorted(found, key=lambda f: f[0])]
+
+    def nearest_sprites(self, pos, k=1, max_radius=None, exclude=None, **desc):
+        # Up to k sprites with their centres nearest to pos, nearest first. The search
+        # square grows from one cell until the k-th nearest is known to be within it.
+        index = self.spatial_index()
+        x, y = pos
+        r = index.cell_size
+        while True:
+            if max_radius is not None:
+                r = min(r, max_radius)
+            near = self.sprites_near(cdkkRect(x - r, y - r, 2 * r + 1, 2 * r + 1))
+            found = sorted(self._centre_distances(near, pos, exclude, desc), key=lambda f: f[0])
+            if max_radius is not None:
+                found = [f for f in found if f[0] <= max_radius]
+            done = (len(found) >= k and found[k-1][0] <= r)
+            if done or len(near) >= len(index) or (max_radius is not None and r >= max_radius):
+                return [s for d, s in found[:k]]
+            r = r * 2
+
     def draw(self, surface):
         for s in self.sprites():
             s.draw()  # Ask each sprite to draw its image attribute and update rect
         super().draw(surface)
 
+    def find_dirty_rects(self):
+        # Ask each sprite to draw, then return the screen areas that have changed:
+        # sprites that moved, were redrawn (_draw_reqd), changed image or were removed.
+        # Sprites that draw on their image outside draw() must set _draw_reqd.
+        dirty = self.lostsprites
+        self.lostsprites = []
+        for s in self.sprites():
+            changed = s._draw_reqd
+            s.draw()
+            old_rect = self.spritedict[s]
+            new_rect = cdkkRect(s.rect.topleft, s.image.get_size())
+            if old_rect is self._init_rect:
+                dirty.append(new_rect)
+            elif changed or new_rect != old_rect or s.image is not self._drawn_images.get(s):
+                if new_rect.colliderect(old_rect):
+                    dirty.append(new_rect.union(old_rect))
+                else:
+                    dirty.append(new_rect)
+                    dirty.append(old_rect)
+        return dirty
+
+    def draw_dirty(self, surface, dirty_rects):
+        # Redraw the parts of each sprite that overlap the (non-overlapping) dirty rects
+        drawn_images = {}
+        for s in self.sprites():
+            image = s.image
+            rect = cdkkRect(s.rect.topleft, image.get_size())
+            for i in rect.collidelistall(dirty_rects):
+                area = rect.clip(dirty_rects[i])
+                surface.blit(image, area, area.move(-rect.left, -rect.top))
+            self.spritedict[s] = rect
+            drawn_images[s] = image
+        self._drawn_images = drawn_images
+
     def sprite(self, name):
         ret_sprite = None
         for s in self.sprites():
@@ -116,19 +319,26 @@ class SpriteManager(pygame.sprite.LayeredUpdates):
         return len(sprites)
 
     def find_collisions(self):
-        sprite_dict = pygame.sprite.groupcollide(self, self, False, False)
-        self_collisions = []
-        for spr in sprite_dict:
-            sprite_dict[spr].remove(spr)
-            if len(sprite_dict[spr]) == 0:
-                self_collisions.append(spr)
-
-        for spr in self_collisions:
-            sprite_dict.pop(spr)
+        # Each sprite that overlaps another, with the rect of the first (in sprites() order)
+        # that it overlaps. Only pairs that share a spatial index cell, and whose collision
+        # categories and masks match (see collide_filter), are tested.
+        index = self.spatial_index()
+        sprites = self.sprites()
+        order = self._spatial_order
+        filters = {s: collide_filter(s) for s in sprites}
+        first = {}
+        for a, b in index.pairs():
+            if can_collide(filters[a], filters[b]) and a.rect.colliderect(b.rect):
+                ia, ib = order[a], order[b]
+                if ib < first.get(a, len(sprites)):
+                    first[a] = ib
+                if ia < first.get(b, len(sprites)):
+                    first[b] = ia
 
         sprite_collisions = []
-        for spr, spr_list in sprite_dict.items():
-            sprite_collisions.append((spr, spr_list[0].rect))
+        for spr in sprites:
+            if spr in first:
+                sprite_collisions.append((spr, sprites[first[spr]].rect))
 
         return sprite_collisions
 
@@ -195,6 +405,7 @@ class SM_Scoreboard(SpriteManager):
         self._score_value = 0
         self.score_text = Sprite_TextBox(
             "Score", cdkkRect(70, 10, 200, 40), score_style)
+        self.score_text.set_config("skip_same_text", True)
         self.score_text.set_text_format("Score: {0}", self._score_value)
         self.add(self.score_text)
 
@@ -202,12 +413,14 @@ class SM_Scoreboard(SpriteManager):
         self.game_time = game_time
         self.timer_text = Sprite_TextBox("Time Left", cdkkRect(
             limits.width - 250, 10, 200, 40), timer_style)
+        self.timer_text.set_config("skip_same_text", True)
         self.timer_text.set_text_format("Time Left: {0:0.1f}",
                                         self.time_left)
         self.add(self.timer_text)
 
         self.fps_text = Sprite_TextBox("FPS", cdkkRect(
             limits.centerx-100, 10, 200, 40), fps_style)
+        self.fps_text.set_config("skip_same_text", True)
         self.fps_text.set_text_format("FPS: {0:4.1f}", 0)
         self.add(self.fps_text)
 
@@ -294,12 +507,28 @@ class SM_SplashScreen(SpriteManager):
         splash.load_image_from_file(filename)
         splash.rect.center = limits.center
         self.add(splash)
+        self._splash = splash
         self._splash_displayed = True
         self._clear_timer = Timer(display_time, EVENT_GAME_FLOW)
+        self._progress_bar = None
+        self._loading = False     # Assets are being preloaded (see PyGameApp.preload_assets)
+        self._clear_reqd = False  # Display time is up, but still loading
+
+    def show_progress(self, progress):
+        # A bar under the splash image, 0-1 of its width
+        splash = self._splash
+        if self._progress_bar is None:
+            self._progress_bar = Sprite_Shape("Progress Bar", style=stylesheet.style("ProgressBar"))
+            self.add(self._progress_bar)
+        width = max(1, int(splash.rect.width * progress))
+        self._progress_bar.create_canvas(width, self._progress_bar.get_style("height"))
+        self._progress_bar.rect.topleft = (splash.rect.left, splash.rect.bottom + 10)
 
     def clear_splash(self):
         self.empty()
         self._splash_displayed = False
+        self._progress_bar = None
+        self._clear_reqd = False
 
         if self.get_app_config("auto_start") == True:
             logger.warning(
@@ -313,8 +542,20 @@ class SM_SplashScreen(SpriteManager):
         dealt_with = super().event(e)
         if not dealt_with and e.type == EVENT_GAME_FLOW:
             if self._splash_displayed:
-                self.clear_splash()
+                if self._loading:
+                    self._clear_reqd = True
+                else:
+                    self.clear_splash()
                 dealt_with = True
+        elif not dealt_with and e.type == EVENT_GAME_CONTROL and self._splash_displayed:
+            # Progress events are left for other managers too
+            if e.action == "AssetProgress":
+                self._loading = (e.info["loaded"] < e.info["total"])
+                self.show_progress(e.info["progress"])
+            elif e.action == "AssetsLoaded":
+                self._loading = False
+                if self._clear_reqd:
+                    self.clear_splash()
         return dealt_with
 
 # --------------------------------------------------
@@ -3,11 +3,21 @@
 
 import pygame
 import math
-from collections import deque
+from collections import deque, OrderedDict
 import random
+import weakref
 import os
-import msvcrt
+import time
+import struct
+import pickle
+import json
 import re
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy  # Optional: only needed for array-backed features, e.g. Sprite_Particles
+except ImportError:
+    numpy = None
 
 # --------------------------------------------------
 
@@ -40,6 +50,7 @@ def merge_dicts(*dict_args):
 # --------------------------------------------------
 
 def read_single_key(match_pattern=None, as_upper=True, as_int=False):
+    import msvcrt  # Windows only, so not imported with the module
     ret_code = None
     wait_for_key = True
 
@@ -134,11 +145,29 @@ CONTROL_KEYBOARD = 1
 CONTROL_MOUSE = 2
 CONTROL_JOYSTICK = 4
 
+# Collision categories and masks (bit flags), see sprite config "collide_category" and "collide_mask".
+# Two sprites can only collide if each one's category is in the other's mask.
+COLLIDE_NONE = 0
+COLLIDE_DEFAULT = 1
+COLLIDE_ALL = 0xFFFFFFFF
+
 # --------------------------------------------------
 
 def rect_to_debug_str(r):
     return "Left-Top=({0},{1}), Width-Height=({2},{3})".format(r.left, r.top, r.width, r.height)
 
+def merge_rects(rects):
+    # Union overlapping rects until none overlap, so no area is redrawn twice
+    merged = []
+    for r in rects:
+        r = pygame.Rect(r)
+        i = r.collidelist(merged)
+        while i >= 0:
+            r.union_ip(merged.pop(i))
+            i = r.collidelist(merged)
+        merged.append(r)
+    return merged
+
 # --------------------------------------------------
 
 
@@ -222,11 +251,12 @@ class Physics_Limit:
 class Physics:
     gravity = 9.81
     perfect_bounce = 1
+    physics_world = None  # Set while a PhysicsWorld steps this rect (see PhysicsWorld)
 
     def __init__(self):
-        self._init_motion = Physics_Motion()
-        self._curr_motion = Physics_Motion()
-        self._timers = [Timer(0, None, False), Timer(0, None, False)]
+        self._motion_init = Physics_Motion()
+        self._motion_curr = Physics_Motion()
+        self._motion_timers = [Timer(0, None, False), Timer(0, None, False)]
         self._moving = False
         self.rect_width = 0
         self.rect_height = 0
@@ -238,6 +268,50 @@ class Physics:
         self.negate_acc = 0.9
         self._limits = []
 
+    # The motion state is changed through these properties, so a rect stepped by a
+    # PhysicsWorld gets its latest state first, and the world re-reads it afterwards.
+    # The _read_ versions only get the latest state, for getters that change nothing.
+    @property
+    def _read_init_motion(self):
+        if self.physics_world is not None:
+            self.physics_world.sync_body(self, changed=False)
+        return self._motion_init
+
+    @property
+    def _read_curr_motion(self):
+        if self.physics_world is not None:
+            self.physics_world.sync_body(self, changed=False)
+        return self._motion_curr
+
+    @property
+    def _read_timers(self):
+        if self.physics_world is not None:
+            self.physics_world.sync_body(self, changed=False)
+        return self._motion_timers
+
+    @property
+    def _init_motion(self):
+        if self.physics_world is not None:
+            self.physics_world.sync_body(self)
+        return self._motion_init
+
+    @property
+    def _curr_motion(self):
+        if self.physics_world is not None:
+            self.physics_world.sync_body(self)
+        return self._motion_curr
+
+    @property
+    def _timers(self):
+        if self.physics_world is not None:
+            self.physics_world.sync_body(self)
+        return self._motion_timers
+
+    def physics_changed(self):
+        # Call after changing an attribute directly (e.g. bounce_cor) while in a PhysicsWorld
+        if self.physics_world is not None:
+            self.physics_world.sync_body(self)
+
     @property
     def debug_str(self):
         return "Pos=({0:3.0f},{1:3.0f}), Vel=({2:5.1f},{3:5.1f}), Acc=({4:5.1f},{5:5.1f}), InitPos=({6:5.1f},{7:5.1f}), InitVel=({8:5.1f},{9:5.1f})".format(
@@ -246,43 +320,43 @@ class Physics:
 
     @property
     def init_pos_x(self):
-        return self._init_motion.position_x
+        return self._read_init_motion.position_x
 
     @property
     def init_pos_y(self):
-        return self._init_motion.position_y
+        return self._read_init_motion.position_y
 
     @property
     def init_vel_x(self):
-        return self._init_motion.velocity_x
+        return self._read_init_motion.velocity_x
 
     @property
     def init_vel_y(self):
-        return self._init_motion.velocity_y
+        return self._read_init_motion.velocity_y
 
     @property
     def curr_acc_x(self):
-        return self._curr_motion.acceleration_x
+        return self._read_curr_motion.acceleration_x
 
     @property
     def curr_acc_y(self):
-        return self._curr_motion.acceleration_y
+        return self._read_curr_motion.acceleration_y
 
     @property
     def curr_pos_x(self):
-        return self._curr_motion.position_x
+        return self._read_curr_motion.position_x
 
     @property
     def curr_pos_y(self):
-        return self._curr_motion.position_y
+        return self._read_curr_motion.position_y
 
     @property
     def curr_vel_x(self):
-        return self._curr_motion.velocity_x
+        return self._read_curr_motion.velocity_x
 
     @property
     def curr_vel_y(self):
-        return self._curr_motion.velocity_y
+        return self._read_curr_motion.velocity_y
 
     @property
     def speed(self):
@@ -304,7 +378,7 @@ class Physics:
 
     @property
     def stopped(self):
-        return self._curr_motion.stopped
+        return self._read_curr_motion.stopped
 
     @curr_pos_x.setter
     def curr_pos_x(self, new_pos_x):
@@ -345,6 +419,7 @@ class Physics:
     @multiplier.setter
     def multiplier(self, multiplier):
         self._multiplier = multiplier
+        self.physics_changed()
 
     def set_velocity(self, vel_x=None, vel_y=None):
         if vel_x is not None:
@@ -422,17 +497,19 @@ class Physics:
 
     @property
     def x_timer_elapsed(self):
-        return self._timers[0].time
+        return self._read_timers[0].time
 
     @property
     def y_timer_elapsed(self):
-        return self._timers[1].time
+        return self._read_timers[1].time
 
     def add_limit(self, limit):
         self._limits.append(limit)
+        self.physics_changed()
 
     def clear_limits(self):
         self._limits.clear()
+        self.physics_changed()
 
     def _calculate_curr_motion(self, dx, dy, use_physics):
         if use_physics:
@@ -724,6 +801,7 @@ class MovingRect(cdkkRect, Physics):
     @use_physics.setter
     def use_physics(self, new_use_physics):
         self._use_physics = new_use_physics
+        self.physics_changed()
 
     def go(self):
         self.set_initial_position(self.left, self.top)
@@ -770,41 +848,568 @@ class MovingRect(cdkkRect, Physics):
 # --------------------------------------------------
 
 
+class SpatialHash():
+    # Uniform grid broad phase: each item is held in every cell (cell_size square) that its
+    # rect overlaps. update() only moves an item when the cells it covers change.
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self._cells = {}       # (col, row) -> set of items
+        self._item_cells = {}  # item -> (col0, row0, col1, row1)
+
+    def __len__(self):
+        return len(self._item_cells)
+
+    def __contains__(self, item):
+        return item in self._item_cells
+
+    def _cell_range(self, rect):
+        cs = self.cell_size
+        left, top, width, height = rect
+        return (left // cs, top // cs, (left + max(width, 1) - 1) // cs, (top + max(height, 1) - 1) // cs)
+
+    def update(self, item, rect):
+        # Add item, or move it to rect; returns True if its cells changed
+        new_range = self._cell_range(rect)
+        old_range = self._item_cells.get(item)
+        if old_range == new_range:
+            return False
+        if old_range is not None:
+            self._remove_cells(item, old_range)
+        self._item_cells[item] = new_range
+        c0, r0, c1, r1 = new_range
+        cells = self._cells
+        for col in range(c0, c1 + 1):
+            for row in range(r0, r1 + 1):
+                cell = cells.get((col, row))
+                if cell is None:
+                    cells[(col, row)] = {item}
+                else:
+                    cell.add(item)
+        return True
+
+    def remove(self, item):
+        old_range = self._item_cells.pop(item, None)
+        if old_range is not None:
+            self._remove_cells(item, old_range)
+
+    def _remove_cells(self, item, cell_range):
+        c0, r0, c1, r1 = cell_range
+        cells = self._cells
+        for col in range(c0, c1 + 1):
+            for row in range(r0, r1 + 1):
+                cell = cells[(col, row)]
+                cell.discard(item)
+                if len(cell) == 0:
+                    del cells[(col, row)]
+
+    def clear(self):
+        self._cells.clear()
+        self._item_cells.clear()
+
+    def query(self, rect):
+        # Items in the cells that rect overlaps (candidates; test their rects to be sure)
+        c0, r0, c1, r1 = self._cell_range(rect)
+        found = set()
+        cells = self._cells
+        if (c1 - c0 + 1) * (r1 - r0 + 1) > len(cells):
+            for (col, row), cell in cells.items():
+                if c0 <= col <= c1 and r0 <= row <= r1:
+                    found.update(cell)
+        else:
+            for col in range(c0, c1 + 1):
+                for row in range(r0, r1 + 1):
+                    cell = cells.get((col, row))
+                    if cell is not None:
+                        found.update(cell)
+        return found
+
+    def pairs(self):
+        # Candidate pairs of items sharing at least one cell, each pair once
+        found = set()
+        for cell in self._cells.values():
+            if len(cell) > 1:
+                items = list(cell)
+                for i, a in enumerate(items):
+                    for b in items[i+1:]:
+                        found.add((a, b) if id(a) < id(b) else (b, a))
+        return found
+
+# --------------------------------------------------
+
+
+class MaskCache():
+    # Collision masks keyed by surface, built the first time they are asked for.
+    # Sprites showing the same surface (e.g. an animation frame) share its mask.
+    # Entries go when their surface does; call invalidate() after drawing on a surface.
+    def __init__(self):
+        self._masks = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._masks)
+
+    def get(self, surface):
+        if surface is None:
+            return None
+        mask = self._masks.get(surface)
+        if mask is None:
+            self.misses += 1
+            mask = self._masks[surface] = pygame.mask.from_surface(surface)
+        else:
+            self.hits += 1
+        return mask
+
+    def invalidate(self, surface):
+        if surface is not None:
+            self._masks.pop(surface, None)
+
+    def clear(self):
+        self._masks.clear()
+        self.hits = self.misses = 0
+
+
+mask_cache = MaskCache()
+
+# --------------------------------------------------
+
+
+class PhysicsWorld():
+    # Steps the physics of many MovingRects at once with numpy (see SpriteManager "physics_world").
+    # Body state is held in arrays, one entry per sprite, and the motion is the same as
+    # MovingRect.move_physics(). LIMIT_KEEP_INSIDE and LIMIT_KEEP_OUTSIDE limits are
+    # tested for all bodies together, honouring the AT_LIMIT_* actions; bodies with other
+    # limits or actions, or not using physics, are moved by move_physics() as before.
+    # A body's MovingRect is brought up to date whenever its motion state is used.
+    MODE_NONE = 0      # Not moved: auto_move_physics is off
+    MODE_ARRAYS = 1    # Moved by the arrays
+    MODE_PYTHON = 2    # Moved by MovingRect.move_physics()
+
+    _fields = ["ipx", "ipy", "ivx", "ivy", "ax", "ay", "cpx", "cpy", "cvx", "cvy",
+               "sx", "sy", "w", "h", "mult", "cor", "low", "init_low"]
+
+    def __init__(self, capacity=64):
+        self._sprites = []
+        self._version = 0  # Incremented by every step(); bodies older than this are out of date
+        self._dirty = set()
+        self._python_bodies = set()
+        self._alloc(capacity, 1)
+
+    def _alloc(self, capacity, max_limits):
+        # (Re)allocate the arrays, keeping the current bodies
+        n = len(self._sprites)
+        old = getattr(self, "_arrays", None)
+        arrays = {f: numpy.zeros(capacity) for f in PhysicsWorld._fields}
+        arrays["runx"] = numpy.zeros(capacity, bool)
+        arrays["runy"] = numpy.zeros(capacity, bool)
+        arrays["mode"] = numpy.zeros(capacity, numpy.int8)
+        arrays["limit_type"] = numpy.zeros((capacity, max_limits), numpy.int32)
+        arrays["limit_action"] = numpy.zeros((capacity, max_limits), numpy.int32)
+        arrays["limit_event"] = numpy.zeros((capacity, max_limits), bool)
+        arrays["limit_rect"] = numpy.zeros((capacity, max_limits, 4))
+        if old is not None:
+            for f, a in arrays.items():
+                k = old[f].shape[1] if a.ndim > 1 else None
+                if k is None:
+                    a[:n] = old[f][:n]
+                else:
+                    a[:n, :k] = old[f][:n]
+        self._arrays = arrays
+        self._capacity = capacity
+        self._max_limits = max_limits
+
+    def __len__(self):
+        return len(self._sprites)
+
+    def add_sprite(self, sprite):
+        rect = sprite.rect
+        if not isinstance(rect, MovingRect) or rect.physics_world is not None:
+            return False
+        if len(self._sprites) == self._capacity:
+            self._alloc(self._capacity * 2, self._max_limits)
+        rect._world_index = len(self._sprites)
+        self._sprites.append(sprite)
+        self._read_body(rect._world_index)
+        rect.physics_world = self
+        return True
+
+    def remove_sprite(self, sprite):
+        rect = sprite.rect
+        if not isinstance(rect, MovingRect) or rect.physics_world is not self:
+            return False
+        self.sync_body(rect)
+        i = rect._world_index
+        last = len(self._sprites) - 1
+        for body_set in (self._dirty, self._python_bodies):
+            body_set.discard(i)
+            if i != last and last in body_set:
+                body_set.discard(last)
+                body_set.add(i)
+        if i != last:
+            # Move the last body into the gap
+            for a in self._arrays.values():
+                a[i] = a[last]
+            moved = self._sprites[last]
+            self._sprites[i] = moved
+            moved.rect._world_index = i
+        self._sprites.pop()
+        rect.physics_world = None
+        return True
+
+    def clear(self):
+        for s in list(self._sprites):
+            self.remove_sprite(s)
+
+    def sync_body(self, rect, changed=True):
+        # Copy the latest state back to rect, and if it is changed re-read it before the next step
+        i = rect._world_index
+        if rect._world_version != self._version:
+            rect._world_version = self._version
+            a = self._arrays
+            if a["mode"][i] == PhysicsWorld.MODE_ARRAYS:
+                init, curr, timers = rect._motion_init, rect._motion_curr, rect._motion_timers
+                init._position[0] = self._pos_value(a["ipx"][i])
+                init._position[1] = self._pos_value(a["ipy"][i])
+                init._velocity[0] = float(a["ivx"][i])
+                init._velocity[1] = float(a["ivy"][i])
+                curr._position[0] = self._pos_value(a["cpx"][i])
+                curr._position[1] = self._pos_value(a["cpy"][i])
+                curr._velocity[0] = float(a["cvx"][i])
+                curr._velocity[1] = float(a["cvy"][i])
+                curr._acceleration[0] = float(a["ax"][i])
+                curr._acceleration[1] = float(a["ay"][i])
+                timers[0]._start_time = float(a["sx"][i])
+                timers[0]._running = bool(a["runx"][i])
+                timers[1]._start_time = float(a["sy"][i])
+                timers[1]._running = bool(a["runy"][i])
+        if changed:
+            self._dirty.add(i)
+
+    def _pos_value(self, value):
+        value = float(value)
+        return int(value) if value.is_integer() else value
+
+    def _limit_supported(self, limit):
+        return (limit.limit_type in (LIMIT_KEEP_INSIDE, LIMIT_KEEP_OUTSIDE)
+                and (limit.action & AT_LIMIT_MOVE_TO_XY) == 0)
+
+    def _read_body(self, i):
+        sprite = self._sprites[i]
+        rect = sprite.rect
+        rect._world_version = self._version
+        a = self._arrays
+        self._python_bodies.discard(i)
+        if not sprite.get_config("auto_move_physics", False):
+            a["mode"][i] = PhysicsWorld.MODE_NONE
+            return
+        limits = rect._limits
+        if not rect.use_physics or not all(self._limit_supported(l) for l in limits):
+            a["mode"][i] = PhysicsWorld.MODE_PYTHON
+            self._python_bodies.add(i)
+            return
+        if len(limits) > self._max_limits:
+            self._alloc(self._capacity, len(limits))
+            a = self._arrays
+
+        init, curr, timers = rect._motion_init, rect._motion_curr, rect._motion_timers
+        a["mode"][i] = PhysicsWorld.MODE_ARRAYS
+        a["ipx"][i], a["ipy"][i] = init._position
+        a["ivx"][i], a["ivy"][i] = init._velocity
+        a["ax"][i], a["ay"][i] = curr._acceleration
+        a["cpx"][i], a["cpy"][i] = curr._position
+        a["cvx"][i], a["cvy"][i] = curr._velocity
+        a["sx"][i], a["runx"][i] = timers[0]._start_time, timers[0]._running
+        a["sy"][i], a["runy"][i] = timers[1]._start_time, timers[1]._running
+        a["w"][i], a["h"][i] = rect.rect_width, rect.rect_height
+        a["mult"][i] = rect._multiplier
+        a["cor"][i] = rect.bounce_cor
+        a["low"][i] = curr.low_limit
+        a["init_low"][i] = init.low_limit
+        a["limit_type"][i] = 0
+        for k, limit in enumerate(limits):
+            a["limit_type"][i, k] = limit.limit_type
+            a["limit_action"][i, k] = rect._eval_action(limit.action)
+            a["limit_event"][i, k] = limit.event is not None
+            a["limit_rect"][i, k] = (limit.rect.left, limit.rect.top, limit.rect.right, limit.rect.bottom)
+
+    def step(self):
+        # Move every body to the current game time
+        for i in self._dirty:
+            self._read_body(i)
+        self._dirty.clear()
+        for i in list(self._python_bodies):
+            self._sprites[i].rect.move_physics()
+
+        n = len(self._sprites)
+        a = {f: v[:n] for f, v in self._arrays.items()}
+        active = numpy.flatnonzero(a["mode"] == PhysicsWorld.MODE_ARRAYS)
+        if len(active) == 0:
+            return
+        now = game_clock.get_ticks()
+        for p, v, s, run, acc in (("cpx", "cvx", "sx", "runx", "ax"), ("cpy", "cvy", "sy", "runy", "ay")):
+            i0 = "ipx" if p == "cpx" else "ipy"
+            iv = "ivx" if p == "cpx" else "ivy"
+            t = numpy.where(a[run][active], (now - a[s][active]) / 1000.0, 0.0)
+            a[p][active] = a[i0][active] + numpy.trunc(
+                (a[iv][active] * t + 0.5 * a[acc][active] * t * t) * a["mult"][active])
+            vel = a[iv][active] + a[acc][active] * t
+            vel[numpy.abs(vel) < a["low"][active]] = 0
+            a[v][active] = vel
+
+        for k in range(self._max_limits):
+            self._apply_limits(a, active[a["limit_type"][active, k] != 0], k, now)
+
+        self._version = self._version + 1
+        cpx = a["cpx"][active].astype(numpy.int64).tolist()
+        cpy = a["cpy"][active].astype(numpy.int64).tolist()
+        sprites = self._sprites
+        for i, x, y in zip(active.tolist(), cpx, cpy):
+            sprites[i].rect.topleft = (x, y)
+
+    def _apply_limits(self, a, idx, k, now):
+        # Test and act on the k-th limit of the bodies in idx, as Physics._apply_limit()
+        if len(idx) == 0:
+            return
+        lt = a["limit_type"][idx, k]
+        act = a["limit_action"][idx, k]
+        L, T, R, B = a["limit_rect"][idx, k].T
+        px, py = a["cpx"][idx], a["cpy"][idx]
+        w, h = a["w"][idx], a["h"][idx]
+
+        inside = (lt == LIMIT_KEEP_INSIDE)
+        outside = ~inside
+        y_overlap = (py + h >= T) & (py <= B)
+        x_overlap = (px + w >= L) & (px <= R)
+        at_left = numpy.where(inside, px - L <= 0, (px + w - L >= 0) & (px - L < 0) & y_overlap)
+        at_right = numpy.where(inside, px + w - R >= 0, (px - R <= 0) & (px + w - R > 0) & y_overlap)
+        at_top = numpy.where(inside, py - T <= 0, (py + h - T >= 0) & (py - T < 0) & x_overlap)
+        at_bottom = numpy.where(inside, py + h - B >= 0, (py - B <= 0) & (py + h - B > 0) & x_overlap)
+        hit_x = at_left | at_right
+        hit_y = at_top | at_bottom
+        hit = hit_x | hit_y
+        if not hit.any():
+            return
+
+        events = numpy.flatnonzero(hit & a["limit_event"][idx, k])
+        if len(events) > 0:
+            self._post_events(idx[events], k, at_left[events] * AT_LIMIT_LEFT + at_right[events] * AT_LIMIT_RIGHT,
+                              at_top[events] * AT_LIMIT_TOP + at_bottom[events] * AT_LIMIT_BOTTOM)
+
+        # AT_LIMIT_X_HOLD_POS_X, AT_LIMIT_Y_HOLD_POS_Y
+        m = ((act & AT_LIMIT_X_HOLD_POS_X) > 0) & hit_x
+        px = numpy.where(m & at_left, numpy.where(inside, L, L - w), px)
+        px = numpy.where(m & at_right, numpy.where(inside, R - w, R), px)
+        m = ((act & AT_LIMIT_Y_HOLD_POS_Y) > 0) & hit_y
+        py = numpy.where(m & at_top, numpy.where(inside, T, T - h), py)
+        py = numpy.where(m & at_bottom, numpy.where(inside, B - h, B), py)
+        a["cpx"][idx] = px
+        a["cpy"][idx] = py
+
+        # AT_LIMIT_X_CLEAR_VEL_X, AT_LIMIT_Y_CLEAR_VEL_Y, AT_LIMIT_XY_CLEAR_VEL_XY
+        clear_xy = ((act & AT_LIMIT_XY_CLEAR_VEL_XY) > 0) & hit
+        self._stop_here(a, idx, px, py, (((act & AT_LIMIT_X_CLEAR_VEL_X) > 0) & hit_x) | clear_xy,
+                        (((act & AT_LIMIT_Y_CLEAR_VEL_Y) > 0) & hit_y) | clear_xy)
+
+        # AT_LIMIT_X_BOUNCE_X, AT_LIMIT_Y_BOUNCE_Y
+        bounce_x = ((act & AT_LIMIT_X_BOUNCE_X) > 0) & hit_x
+        bounce_y = ((act & AT_LIMIT_Y_BOUNCE_Y) > 0) & hit_y
+        for bounce, p, v, ip, iv, s, run in ((bounce_x, px, "cvx", "ipx", "ivx", "sx", "runx"),
+                                             (bounce_y, py, "cvy", "ipy", "ivy", "sy", "runy")):
+            i = idx[bounce]
+            vel = a[v][i] * -a["cor"][i]
+            vel[numpy.abs(vel) < a["init_low"][i]] = 0
+            a[ip][i] = p[bounce]
+            a[iv][i] = vel
+            a[s][i] = now
+            a[run][i] = True
+
+        # AT_LIMIT_STOP
+        stop = ((act & AT_LIMIT_STOP) > 0) & hit
+        self._stop_here(a, idx, px, py, stop, stop)
+
+    def _stop_here(self, a, idx, px, py, stop_x, stop_y):
+        # As Physics.stop_here_x() and stop_here_y()
+        for stop, p, ip, iv, acc in ((stop_x, px, "ipx", "ivx", "ax"), (stop_y, py, "ipy", "ivy", "ay")):
+            i = idx[stop]
+            a[ip][i] = p[stop]
+            a[iv][i] = 0
+            a[acc][i] = 0
+
+    def _post_events(self, idx, k, at_limit_x, at_limit_y):
+        for i, at_x, at_y in zip(idx.tolist(), at_limit_x.tolist(), at_limit_y.tolist()):
+            rect = self._sprites[i].rect
+            rect._post_event_at_limit(rect._limits[k], at_x, at_y)
+
+# --------------------------------------------------
+
+
+class RealClock():
+    # Default time source for the game clock: high resolution, in msecs
+    def get_ticks(self):
+        return time.perf_counter() * 1000.0
+
+
+class VirtualClock():
+    # Time source that only moves when advanced, e.g. for headless runs and replays
+    def __init__(self, start_msecs=0):
+        self._ticks = start_msecs
+
+    def advance(self, msecs):
+        self._ticks = self._ticks + msecs
+
+    def get_ticks(self):
+        return self._ticks
+
+
+class GameClock():
+    # Game time in msecs, read by Timer (and so Physics, GridActor, etc) and LoopTimer.
+    # PyGameApp sets per_frame and calls sample() once per loop, so every timer
+    # sees the same time for the whole frame. Otherwise every read samples the source.
+    # With a fixed_step as well, game time only moves on by advance(), once per step.
+    def __init__(self, source=None):
+        self._source = source if source is not None else RealClock()
+        self._last_source_ticks = self._source.get_ticks()
+        self._ticks = 0.0
+        self._frame_msecs = 0.0
+        self._source_msecs = 0.0
+        self.time_scale = 1.0
+        self.paused = False
+        self.per_frame = False
+        self.fixed_step = None  # msecs per update() when PyGameApp uses a fixed step
+
+    @property
+    def source(self):
+        return self._source
+
+    def set_source(self, source=None):
+        # Game time carries on from its current value with the new source
+        self._source = source if source is not None else RealClock()
+        self._last_source_ticks = self._source.get_ticks()
+
+    def _advance(self):
+        now = self._source.get_ticks()
+        self._source_msecs = now - self._last_source_ticks
+        self._last_source_ticks = now
+        if self.paused:
+            msecs = 0.0
+        else:
+            msecs = self._source_msecs * self.time_scale
+        if not (self.per_frame and self.fixed_step is not None):
+            self._ticks = self._ticks + msecs
+        return msecs
+
+    def advance(self, msecs):
+        # Move game time on by one fixed step (see PyGameApp "fixed_update_time")
+        self._ticks = self._ticks + msecs
+
+    def sample(self):
+        # Returns the game time since the last sample
+        self._frame_msecs = self._advance()
+        return self._frame_msecs
+
+    def get_ticks(self):
+        if not self.per_frame:
+            self._advance()
+        return self._ticks
+
+    @property
+    def frame_msecs(self):
+        # Game time between the last two samples
+        return self._frame_msecs
+
+    @property
+    def source_msecs(self):
+        # Source time between the last two samples, before scaling or pausing
+        return self._source_msecs
+
+    @property
+    def step_msecs(self):
+        # Game time that each update() represents
+        if self.fixed_step is not None:
+            return self.fixed_step
+        else:
+            return self._frame_msecs
+
+    def pause(self):
+        if not self.per_frame:
+            self._advance()
+        self.paused = True
+
+    def resume(self):
+        if not self.per_frame:
+            self._last_source_ticks = self._source.get_ticks()
+        self.paused = False
+
+
+game_clock = GameClock()
+
+# --------------------------------------------------
+
+
 class Timer():
+    _countdowns = weakref.WeakSet()  # Running timers with a timer value
+
+    def next_due_msecs():
+        # Time until the next running countdown expires; None if there are none
+        due = [t.time_left for t in Timer._countdowns]
+        due = [t for t in due if t > 0]
+        if len(due) == 0:
+            return None
+        else:
+            return min(due) * 1000.0
+
     def __init__(self, timer_secs=0, timer_event=None, auto_start=True):
         self._timer_value = timer_secs * 1000.0
-        self._start_time = pygame.time.get_ticks()
-        self._stop_time = pygame.time.get_ticks()
+        self._start_time = game_clock.get_ticks()
+        self._stop_time = game_clock.get_ticks()
         self._timer_event = timer_event
+        self._wheel = None
+        self._wheel_id = None
         self._running = auto_start
         if (auto_start):
             self.start()
 
     def start(self):
-        self._start_time = pygame.time.get_ticks()
+        self._start_time = game_clock.get_ticks()
         self._running = True
+        if self._timer_value > 0:
+            Timer._countdowns.add(self)
         if self._timer_event != None:
-            pygame.time.set_timer(self._timer_event, int(self._timer_value))
+            if TimerWheel.active is not None:
+                # Timers sharing an event type don't cancel each other
+                self.stop_event()
+                if self._timer_value > 0:
+                    self._wheel = TimerWheel.active
+                    self._wheel_id = self._wheel.schedule(
+                        self._timer_value / 1000.0, self._timer_event, repeat=True)
+            else:
+                pygame.time.set_timer(self._timer_event, int(self._timer_value))
 
     def stop(self):
-        self._stop_time = pygame.time.get_ticks()
+        self._stop_time = game_clock.get_ticks()
         self._running = False
+        Timer._countdowns.discard(self)
         self.stop_event()
         return (self._stop_time - self._start_time)/1000.0
 
     def stop_event(self):
-        if self._timer_event != None:
+        if self._wheel is not None:
+            self._wheel.cancel(self._wheel_id)
+            self._wheel = None
+            self._wheel_id = None
+        elif self._timer_event != None:
             pygame.time.set_timer(self._timer_event, 0)
 
     def clear(self):
-        self._start_time = pygame.time.get_ticks()
-        self._stop_time = pygame.time.get_ticks()
+        self._start_time = game_clock.get_ticks()
+        self._stop_time = game_clock.get_ticks()
         self._running = False
+        Timer._countdowns.discard(self)
 
     @property
     def time(self):
         if self._running:
-            time_now = pygame.time.get_ticks()
+            time_now = game_clock.get_ticks()
             return (time_now - self._start_time)/1000.0
         else:
             return 0
@@ -816,7 +1421,7 @@ class Timer():
     @property
     def time_left(self):
         if self._running:
-            time_now = pygame.time.get_ticks()
+            time_now = game_clock.get_ticks()
             time_left = self._timer_value - (time_now - self._start_time)
             time_left = max(time_left, 0)
             return time_left/1000.0
@@ -837,33 +1442,151 @@ class Timer():
 # --------------------------------------------------
 
 
+class TimerWheel():
+    # Hashed timer wheel for many one-shot and repeating timers, run on game time.
+    # Each slot covers slot_msecs; a timer sits in the slot for its due time, and
+    # timers more than one turn of the wheel ahead are skipped until their turn.
+    # A timer fires a callback, posts a game control action or posts an event type.
+    active = None  # Set by PyGameApp; Timer(timer_event=...) uses it instead of pygame.time.set_timer
+
+    def __init__(self, slot_msecs=10, num_slots=256):
+        self._slot_msecs = slot_msecs
+        self._slots = [{} for i in range(num_slots)]
+        self._slot_of = {}  # Timer id -> slot index
+        self._firing = {}   # Timers taken out of the wheel by advance(), not yet run
+        self._next_id = 1
+        self._last_tick = None  # Last slot tick that has been completely run
+
+    def __len__(self):
+        return len(self._slot_of) + len(self._firing)
+
+    def _insert(self, timer_id, entry):
+        tick = int(entry[0] // self._slot_msecs)
+        if self._last_tick is not None:
+            tick = max(tick, self._last_tick + 1)
+        slot = tick % len(self._slots)
+        self._slots[slot][timer_id] = entry
+        self._slot_of[timer_id] = slot
+
+    def schedule(self, secs, target, repeat=False, **info):
+        # target: callable (called with info), game control action (str) or event type (int)
+        # Returns a timer id for cancel()
+        msecs = max(secs * 1000.0, 0)
+        if repeat and msecs <= 0:
+            logger.warning("Repeating timer needs a time greater than 0")
+            return None
+        timer_id = self._next_id
+        self._next_id = self._next_id + 1
+        if self._last_tick is None:
+            self._last_tick = int(game_clock.get_ticks() // self._slot_msecs) - 1
+        entry = [game_clock.get_ticks() + msecs, msecs if repeat else None, target, info]
+        self._insert(timer_id, entry)
+        return timer_id
+
+    def cancel(self, timer_id):
+        slot = self._slot_of.pop(timer_id, None)
+        if slot is not None:
+            del self._slots[slot][timer_id]
+            return True
+        return self._firing.pop(timer_id, None) is not None
+
+    def is_scheduled(self, timer_id):
+        return timer_id in self._slot_of or timer_id in self._firing
+
+    def clear(self):
+        for slot in self._slots:
+            slot.clear()
+        self._slot_of.clear()
+        self._firing.clear()
+
+    def next_due_msecs(self):
+        # Time until the next timer is due; None if there are none
+        if len(self._slot_of) == 0:
+            return None
+        due = min(entry[0] for slot in self._slots for entry in slot.values())
+        return max(due - game_clock.get_ticks(), 0)
+
+    def advance(self, now=None):
+        # Run every timer due by now (msecs of game time). The current, partial
+        # tick is revisited next time. A repeating timer fires at most once per call.
+        if now is None:
+            now = game_clock.get_ticks()
+        now_tick = int(now // self._slot_msecs)
+        if self._last_tick is None:
+            self._last_tick = now_tick - 1
+        ticks = now_tick - self._last_tick
+        num_slots = len(self._slots)
+        if ticks >= num_slots:
+            slots = range(num_slots)
+        else:
+            slots = [t % num_slots for t in range(self._last_tick + 1, now_tick + 1)]
+        for slot in slots:
+            due = [tid for tid, entry in self._slots[slot].items() if entry[0] <= now]
+            for timer_id in due:
+                self._firing[timer_id] = self._slots[slot].pop(timer_id)
+                del self._slot_of[timer_id]
+        self._last_tick = now_tick - 1
+
+        fired = sorted(self._firing.items(), key=lambda item: (item[1][0], item[0]))
+        for timer_id, entry in fired:
+            if timer_id not in self._firing:
+                continue  # Cancelled by an earlier timer
+            self._fire(entry)
+            if self._firing.pop(timer_id, None) is not None and entry[1] is not None:
+                entry[0] = entry[0] + entry[1]
+                self._insert(timer_id, entry)
+        return len(fired)
+
+    def _fire(self, entry):
+        target, info = entry[2], entry[3]
+        if callable(target):
+            target(**info)
+        elif isinstance(target, str):
+            EventManager.post_game_control(target, **info)
+        else:
+            EventManager.post(EventManager.create_event(target, **info))
+
+# --------------------------------------------------
+
+
 class LoopTimer():
     def __init__(self, max_loops, auto_start=True):
         self._queue = deque([0] * max_loops, max_loops)
-        self._timer = Timer(auto_start=auto_start)
+        self._total = 0
+        self._last_ticks = None
         self._loop_counter = 0
+        if auto_start:
+            self.start()
 
     def start(self):
-        self._timer.start()
+        self._last_ticks = game_clock.get_ticks()
 
     def append(self, loop_time=None):
+        # loop_time in msecs; default is the game clock time since the last append()
+        now = game_clock.get_ticks()
         if loop_time is None:
-            loop_time = self._timer.time_msecs
+            if self._last_ticks is None:
+                loop_time = 0
+            else:
+                loop_time = now - self._last_ticks
+        self._total = self._total + loop_time - self._queue[0]
         self._queue.append(loop_time)
-        self._timer.start()
+        self._last_ticks = now
         self._loop_counter = self._loop_counter + 1
+        if self._loop_counter % len(self._queue) == 0:
+            self._total = sum(self._queue)  # Avoid rounding drift
 
     @property
     def msecs_per_loop(self):
-        return sum(self._queue) / len(self._queue)
+        return self._total / len(self._queue)
 
     @property
     def loops_per_sec(self):
         msecs = self.msecs_per_loop
-        if msecs == 0:
+        if msecs <= 0:
             return 0
         else:
-            return 1000.0 / self.msecs_per_loop
+            return 1000.0 / msecs
 
     @property
     def loops(self):
@@ -872,6 +1595,146 @@ class LoopTimer():
 # --------------------------------------------------
 
 
+class FrameHistogram():
+    # Streaming histogram of timings in nsecs. Buckets are log-linear, so
+    # percentiles are accurate to about 3% whatever the number of samples.
+    sub_bucket_bits = 5
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._buckets = {}
+        self._count = 0
+        self._total = 0
+        self._max = 0
+        self._last = 0
+
+    def add(self, nsecs):
+        nsecs = max(int(nsecs), 0)
+        shift = max(nsecs.bit_length() - self.sub_bucket_bits, 0)
+        bucket = (shift, nsecs >> shift)
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        self._count = self._count + 1
+        self._total = self._total + nsecs
+        self._max = max(self._max, nsecs)
+        self._last = nsecs
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def mean_msecs(self):
+        if self._count == 0:
+            return 0
+        else:
+            return self._total / self._count / 1000000.0
+
+    @property
+    def max_msecs(self):
+        return self._max / 1000000.0
+
+    @property
+    def last_msecs(self):
+        return self._last / 1000000.0
+
+    def percentile_msecs(self, pc):
+        if self._count == 0:
+            return 0
+        rank = max(math.ceil(pc / 100.0 * self._count), 1)
+        running = 0
+        for shift, sub in sorted(self._buckets):
+            running = running + self._buckets[(shift, sub)]
+            if running >= rank:
+                # Report the middle of the bucket
+                nsecs = (sub << shift) + ((1 << shift) - 1) / 2.0
+                return min(nsecs, self._max) / 1000000.0
+        return self.max_msecs
+
+    @property
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_msecs": self.mean_msecs,
+            "p50_msecs": self.percentile_msecs(50),
+            "p95_msecs": self.percentile_msecs(95),
+            "p99_msecs": self.percentile_msecs(99),
+            "max_msecs": self.max_msecs
+        }
+
+
+class FrameProfiler():
+    # Times each loop phase, in total and per owner (e.g. sprite manager).
+    # Times within a frame are added together and recorded by end_frame().
+    # Owners are shown by name in summary; owners sharing a name are numbered, e.g. "Enemies #2".
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._histograms = {}   # Key = (phase, owner)
+        self._frame = {}        # Key = (phase, owner), Value = nsecs this frame
+        self._frame_start = time.perf_counter_ns()
+        self._frames = 0
+
+    @property
+    def frames(self):
+        return self._frames
+
+    def start(self):
+        return time.perf_counter_ns()
+
+    def stop(self, start_ns, phase, owner=None):
+        nsecs = time.perf_counter_ns() - start_ns
+        key = (phase, owner)
+        self._frame[key] = self._frame.get(key, 0) + nsecs
+        return nsecs
+
+    def end_frame(self):
+        now_ns = time.perf_counter_ns()
+        self._frame[("frame", None)] = now_ns - self._frame_start
+        self._frame_start = now_ns
+        for key, nsecs in self._frame.items():
+            if key not in self._histograms:
+                self._histograms[key] = FrameHistogram()
+            self._histograms[key].add(nsecs)
+        self._frame.clear()
+        self._frames = self._frames + 1
+
+    def histogram(self, phase, owner=None):
+        return self._histograms.get((phase, owner))
+
+    @property
+    def phases(self):
+        return sorted(set(phase for phase, owner in self._histograms))
+
+    def owners(self, phase):
+        return [owner for p, owner in self._histograms if p == phase and owner is not None]
+
+    def _owner_names(self):
+        names = {}
+        counts = {}
+        for phase, owner in self._histograms:
+            if owner is not None and owner not in names:
+                name = str(getattr(owner, "name", owner))
+                counts[name] = counts.get(name, 0) + 1
+                names[owner] = name if counts[name] == 1 else "{0} #{1}".format(name, counts[name])
+        return names
+
+    @property
+    def summary(self):
+        # {phase: {"total": {...}, owner name: {...}}}
+        names = self._owner_names()
+        stats = {}
+        for (phase, owner), hist in self._histograms.items():
+            if phase not in stats:
+                stats[phase] = {}
+            stats[phase]["total" if owner is None else names[owner]] = hist.summary
+        return stats
+
+# --------------------------------------------------
+
+
 EVENT_READ_KEYBOARD = pygame.USEREVENT
 EVENT_SCROLL_GAME = pygame.USEREVENT + 1
 EVENT_GAME_CONTROL = pygame.USEREVENT + 2
@@ -882,11 +1745,13 @@ EVENT_NEXT_USER_EVENT = pygame.USEREVENT + 6
 
 # Game Control Actions
 #   e.action: StartGame, GameOver, ClearGameOver, QuitGame, Board, Pass, Hint, ClearHint, Print, Keyboard,
-#             UpdateScore, KillSpriteUUID, MouseMotion, MouseLeftClick, MouseRightClick, MouseUnclick
+#             UpdateScore, KillSpriteUUID, MouseMotion, MouseLeftClick, MouseRightClick, MouseUnclick,
+#             AssetProgress, AssetsLoaded
 #   e.info: Dictionary with additional event information, including:
 #             pos   - Mouse position for MouseMotion, MouseLeftClick, MouseRightClick and MouseUnclick
 #             value - Delta value for UpdateScore
 #             key   - Name of key pressed
+#             loaded, total, progress - Assets loaded so far for AssetProgress (see AssetPreloader)
 
 class EventManager:
     def info_to_str(e):
@@ -1037,6 +1902,96 @@ class EventManager:
 # --------------------------------------------------
 
 
+class EventRecorder:
+    # Binary event log: header = magic + random seed, then one entry per event:
+    # frame, event type, payload length, pickled (action, info).
+    # Raw pygame events have action None and their attributes as info.
+    # The time taken by each frame is logged as event type NOEVENT.
+    file_magic = b"CDKKEVT1"
+    header_format = struct.Struct("<8sQ")
+    entry_format = struct.Struct("<IHI")
+    msecs_format = struct.Struct("<d")
+
+    def __init__(self, filename, seed=None):
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        self.events = 0
+        self._file = open(filename, "wb")
+        self._file.write(EventRecorder.header_format.pack(EventRecorder.file_magic, seed))
+
+    def record(self, frame, e):
+        if e.type == EVENT_GAME_CONTROL or ("action" in e.dict and "info" in e.dict):
+            action_info = (e.action, e.info)
+        else:
+            action_info = (None, e.dict)
+        try:
+            payload = pickle.dumps(action_info, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            logger.warning("EventRecorder: Cannot record event type {0}".format(e.type))
+            return False
+        self._write(frame, e.type, payload)
+        self.events = self.events + 1
+        return True
+
+    def record_frame_time(self, frame, msecs):
+        self._write(frame, pygame.NOEVENT, EventRecorder.msecs_format.pack(msecs))
+
+    def _write(self, frame, event_type, payload):
+        self._file.write(EventRecorder.entry_format.pack(frame, event_type, len(payload)))
+        self._file.write(payload)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class EventReplayer:
+    # Reads a log written by EventRecorder
+    def __init__(self, filename):
+        self._events = {}       # Key = frame, Value = list of events
+        self._frame_msecs = {}  # Key = frame, Value = msecs
+        self.last_frame = -1
+        with open(filename, "rb") as f:
+            data = f.read()
+
+        magic, self.seed = EventRecorder.header_format.unpack_from(data, 0)
+        if magic != EventRecorder.file_magic:
+            logger.error("EventReplayer: {0} is not an event log".format(filename))
+            return
+
+        pos = EventRecorder.header_format.size
+        entry_size = EventRecorder.entry_format.size
+        while pos + entry_size <= len(data):
+            frame, event_type, length = EventRecorder.entry_format.unpack_from(data, pos)
+            pos = pos + entry_size
+            payload = data[pos:pos+length]
+            pos = pos + length
+            self.last_frame = max(self.last_frame, frame)
+            if event_type == pygame.NOEVENT:
+                self._frame_msecs[frame] = EventRecorder.msecs_format.unpack(payload)[0]
+            else:
+                action, info = pickle.loads(payload)
+                if action is None:
+                    e = pygame.event.Event(event_type, info)
+                else:
+                    e = pygame.event.Event(event_type, {"action": action, "info": info})
+                self._events.setdefault(frame, []).append(e)
+
+    def events(self, frame):
+        return list(self._events.get(frame, []))
+
+    def frame_msecs(self, frame, default=0):
+        return self._frame_msecs.get(frame, default)
+
+    def finished(self, frame):
+        # True for the last recorded frame, which is still run, as it was when recording
+        return frame >= self.last_frame
+
+# --------------------------------------------------
+
+
 class RandomQueue:
     def __init__(self, queue_len, min_val, max_val, max_change=20, max_change_rate=3, init_value=0):
         self._queue = deque([init_value] * queue_len, queue_len)
@@ -1183,8 +2138,665 @@ class Animation_Counter:
 # --------------------------------------------------
 
 
+class AssetCache():
+    # Loaded images keyed by path and processing (img_process, crop, scale_to), so a file is
+    # decoded and processed once however many sprites use it. Least recently used images are
+    # dropped when the cache holds more than max_bytes; sprites using them keep their copy.
+    # Cached surfaces are shared: call cdkkImage.make_writable() (or Sprite.make_writable())
+    # before drawing on one.
+    def __init__(self, max_bytes=64*1024*1024):
+        self._images = OrderedDict()
+        self._shared = weakref.WeakSet()
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, key):
+        return key in self._images
+
+    @property
+    def stats(self):
+        return {"images": len(self._images), "bytes": self.bytes_used, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def key(self, path, img_process=None, crop=None, scale_to=None):
+        return (os.path.abspath(path), AssetCache._freeze(img_process), AssetCache._freeze(crop), AssetCache._freeze(scale_to))
+
+    def _freeze(value):
+        # Lists (e.g. img_process) to tuples, so they can be part of a key
+        if isinstance(value, (list, tuple)):
+            return tuple(AssetCache._freeze(v) for v in value)
+        return value
+
+    def _surface_bytes(surface):
+        return surface.get_pitch() * surface.get_height()
+
+    def share(self, surface):
+        # Mark a surface as shared, e.g. one made from a cached image (see is_shared)
+        self._shared.add(surface)
+        return surface
+
+    def is_shared(self, surface):
+        # True for a cached or shared surface, or a subsurface of one
+        while surface is not None:
+            if surface in self._shared:
+                return True
+            surface = surface.get_parent()
+        return False
+
+    def get(self, key):
+        surface = self._images.get(key)
+        if surface is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._images.move_to_end(key)
+        return surface
+
+    def put(self, key, surface):
+        if key in self._images:
+            self.bytes_used -= AssetCache._surface_bytes(self._images.pop(key))
+        self._images[key] = self.share(surface)
+        self.bytes_used += AssetCache._surface_bytes(surface)
+        self.trim()
+        return surface
+
+    def trim(self):
+        # Drop least recently used images until within max_bytes, keeping the newest
+        while self.bytes_used > self.max_bytes and len(self._images) > 1:
+            key, surface = self._images.popitem(last=False)
+            self.bytes_used -= AssetCache._surface_bytes(surface)
+            self.evictions += 1
+
+    def load(self, path, img_process=None, crop=None, scale_to=None):
+        key = self.key(path, img_process, crop, scale_to)
+        surface = self.get(key)
+        if surface is None:
+            img = cdkkImage()
+            img.surface = pygame.image.load(path).convert_alpha()
+            img.process_list(img_process, crop=crop, scale=scale_to)
+            surface = self.put(key, img.surface)
+        return surface
+
+    def clear(self):
+        self._images.clear()
+        self.bytes_used = 0
+        self.hits = self.misses = self.evictions = 0
+
+
+asset_cache = AssetCache()
+
+# --------------------------------------------------
+
+
+class FrameStore():
+    # Spritesheet frames, sliced once per (sheet, cols, rows, processing) and shared by every
+    # sprite using them. Unprocessed frames are subsurfaces of the sheet, so nothing is copied;
+    # processed frames are made the first time they are used. Sheets least recently used are
+    # dropped when they and their frames take more than max_bytes (the sheet is counted, as it
+    # is kept here even if asset_cache drops it). Frames are shared (see AssetCache).
+    def __init__(self, max_bytes=64*1024*1024):
+        self._sheets = OrderedDict()
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._sheets)
+
+    @property
+    def stats(self):
+        return {"sheets": len(self._sheets), "bytes": self.bytes_used, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def _sheet(self, path, cols, rows, img_process, crop, scale_to):
+        key = (asset_cache.key(path, img_process, crop, scale_to), cols, rows)
+        sheet = self._sheets.get(key)
+        if sheet is None:
+            surface = asset_cache.load(path)
+            cell_size = (surface.get_width() // cols, surface.get_height() // rows)
+            processed = not (img_process is None and crop is None and scale_to is None)
+            sheet = self._sheets[key] = {"surface": surface, "cols": cols, "cell_size": cell_size,
+                                         "processing": (img_process, crop, scale_to) if processed else None,
+                                         "frames": [None] * (cols * rows), "bytes": 0}
+            self._add_bytes(sheet, AssetCache._surface_bytes(surface))
+        else:
+            self._sheets.move_to_end(key)
+        return sheet
+
+    def _add_bytes(self, sheet, num_bytes):
+        sheet["bytes"] += num_bytes
+        self.bytes_used += num_bytes
+
+    def _set_frame(self, sheet, number, frame):
+        # Frames that are (subsurfaces of) the sheet take no more memory
+        sheet["frames"][number] = frame
+        root = frame
+        while root.get_parent() is not None:
+            root = root.get_parent()
+        if root is not sheet["surface"]:
+            self._add_bytes(sheet, AssetCache._surface_bytes(root))
+
+    def _cell(self, sheet, number):
+        w, h = sheet["cell_size"]
+        return sheet["surface"].subsurface((w * (number % sheet["cols"]), h * (number // sheet["cols"]), w, h))
+
+    def _pipeline(self, sheet):
+        img_process, crop, scale_to = sheet["processing"]
+        return ImagePipeline.compile(cdkkImage.process_steps(img_process, crop=crop, scale=scale_to))
+
+    def _frame(self, sheet, number):
+        frame = sheet["frames"][number]
+        if frame is None:
+            self.misses += 1
+            frame = self._cell(sheet, number)
+            if sheet["processing"] is not None:
+                frame = asset_cache.share(self._pipeline(sheet).apply(frame, cdkkImage()))
+            self._set_frame(sheet, number, frame)
+        else:
+            self.hits += 1
+        return frame
+
+    def frame(self, path, cols, rows, number, img_process=None, crop=None, scale_to=None):
+        frame = self._frame(self._sheet(path, cols, rows, img_process, crop, scale_to), number)
+        self.trim()
+        return frame
+
+    def frames(self, path, cols, rows, img_process=None, crop=None, scale_to=None, start=0, end=None):
+        # Processed frames not made yet are made together on a thread pool
+        sheet = self._sheet(path, cols, rows, img_process, crop, scale_to)
+        if end is None:
+            end = cols * rows
+        todo = [i for i in range(start, end) if sheet["frames"][i] is None]
+        if sheet["processing"] is not None and len(todo) > 1:
+            done = self._pipeline(sheet).apply_many([self._cell(sheet, i) for i in todo])
+            for i, frame in zip(todo, done):
+                self._set_frame(sheet, i, asset_cache.share(frame))
+            self.misses += len(todo)
+            self.hits += (end - start) - len(todo)
+            frames = sheet["frames"][start:end]
+        else:
+            frames = [self._frame(sheet, i) for i in range(start, end)]
+        self.trim()
+        return frames
+
+    def trim(self):
+        # Drop the least recently used sheets until within max_bytes, keeping the newest
+        while self.bytes_used > self.max_bytes and len(self._sheets) > 1:
+            key, sheet = self._sheets.popitem(last=False)
+            self.bytes_used -= sheet["bytes"]
+            self.evictions += 1
+
+    def clear(self):
+        self._sheets.clear()
+        self.bytes_used = 0
+        self.hits = self.misses = self.evictions = 0
+
+
+frame_store = FrameStore()
+
+# --------------------------------------------------
+
+
+class AtlasRegion():
+    # A named rectangle on one page of a TextureAtlas; surface is a subsurface of the page
+    __slots__ = ("name", "page", "rect", "_atlas", "_surface")
+
+    def __init__(self, atlas, name, page, rect):
+        self._atlas = atlas
+        self.name = name
+        self.page = page
+        self.rect = pygame.Rect(rect)
+        self._surface = None
+
+    def __repr__(self):
+        return "<AtlasRegion {0} page={1} {2}>".format(self.name, self.page, self.rect)
+
+    @property
+    def size(self):
+        return self.rect.size
+
+    @property
+    def surface(self):
+        if self._surface is None:
+            self._surface = self._atlas.pages[self.page].subsurface(self.rect)
+        return self._surface
+
+
+class TextureAtlas():
+    # Packs many small images onto a few large surfaces (pages), using shelves: images are
+    # placed left to right in rows, tallest first. add() or add_file() images, then build().
+    # Regions are looked up by name, e.g. sprite.load_image_from_region(atlas["ship"]).
+    # save() writes the pages as PNGs with a JSON index, that load() reads back.
+    def __init__(self, page_size=(1024, 1024), padding=1):
+        self.page_size = page_size
+        self.padding = padding
+        self.pages = []
+        self._regions = {}
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._regions)
+
+    def __contains__(self, name):
+        return name in self._regions
+
+    def __getitem__(self, name):
+        return self._regions[name]
+
+    def region(self, name):
+        return self._regions.get(name)
+
+    @property
+    def names(self):
+        return list(self._regions)
+
+    def add(self, name, surface):
+        self._pending[name] = surface
+
+    def add_file(self, filename, name=None, img_process=None, crop=None, scale_to=None):
+        # Images are decoded here, not cached: the atlas pages are what is kept
+        img = cdkkImage()
+        img.surface = pygame.image.load(img.image_path(filename)).convert_alpha()
+        img.process_list(img_process, crop=crop, scale=scale_to)
+        self.add(filename if name is None else name, img.surface)
+
+    def _pack(self, sizes):
+        # sizes = {name: (w, h)} -> ({name: (page, x, y)}, [page (w, h) used])
+        # Padding is only added between images, so an image can fit up to the page edge
+        page_w, page_h = self.page_size
+        pad = self.padding
+        places = {}
+        pages = []  # Per page: [shelves, next_y, used_w], a shelf is [y, height, next_x]
+        for name in sorted(sizes, key=lambda n: (sizes[n][1], sizes[n][0]), reverse=True):
+            w, h = sizes[name]
+            if w > page_w or h > page_h:
+                logger.warning("TextureAtlas.build(): {0} is bigger than a page, so has a page of its own".format(name))
+                places[name] = (len(pages), 0, 0)
+                pages.append([[], h + pad, w])
+                continue
+            placed = False
+            for p, page in enumerate(pages):
+                shelves, next_y, used_w = page
+                for shelf in shelves:
+                    if h + pad <= shelf[1] and shelf[2] + w <= page_w:
+                        places[name] = (p, shelf[2], shelf[0])
+                        page[2] = max(used_w, shelf[2] + w)
+                        shelf[2] += w + pad
+                        placed = True
+                        break
+                if not placed and next_y + h <= page_h:
+                    shelves.append([next_y, h + pad, w + pad])
+                    places[name] = (p, 0, next_y)
+                    page[1] = next_y + h + pad
+                    page[2] = max(used_w, w)
+                    placed = True
+                if placed:
+                    break
+            if not placed:
+                places[name] = (len(pages), 0, 0)
+                pages.append([[[0, h + pad, w + pad]], h + pad, w])
+        return places, [(page[2], page[1] - pad) for page in pages]
+
+    def build(self):
+        # Pack the images added since the last build onto new pages
+        if not self._pending:
+            return self
+        sizes = {name: surface.get_size() for name, surface in self._pending.items()}
+        places, page_sizes = self._pack(sizes)
+        first_page = len(self.pages)
+        for size in page_sizes:
+            self.pages.append(asset_cache.share(pygame.Surface(size, pygame.SRCALPHA).convert_alpha()))
+        for name, (p, x, y) in places.items():
+            page = first_page + p
+            self.pages[page].blit(self._pending[name], (x, y))
+            self._regions[name] = AtlasRegion(self, name, page, (x, y) + sizes[name])
+        self._pending = {}
+        return self
+
+    def save(self, filename):
+        # filename is the JSON index; pages are saved alongside as <name>_<page>.png
+        self.build()
+        path = cdkkImage().image_path(filename)
+        base = os.path.splitext(os.path.basename(path))[0]
+        page_files = []
+        for i, page in enumerate(self.pages):
+            page_file = "{0}_{1}.png".format(base, i)
+            pygame.image.save(page, os.path.join(os.path.dirname(path), page_file))
+            page_files.append(page_file)
+        index = {"pages": page_files,
+                 "regions": {name: [r.page] + list(r.rect) for name, r in self._regions.items()}}
+        with open(path, "w") as f:
+            json.dump(index, f, indent=1)
+
+    def load(self, filename):
+        path = cdkkImage().image_path(filename)
+        try:
+            with open(path) as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error("TextureAtlas.load(): Can't read {0}: {1}".format(path, e))
+            return self
+        first_page = len(self.pages)
+        for page_file in index["pages"]:
+            self.pages.append(asset_cache.load(os.path.join(os.path.dirname(path), page_file)))
+        for name, (page, x, y, w, h) in index["regions"].items():
+            self._regions[name] = AtlasRegion(self, name, first_page + page, (x, y, w, h))
+        return self
+
+# --------------------------------------------------
+
+
+class AssetPreloader():
+    # Loads a manifest of images and spritesheets into asset_cache (and frame_store) in the
+    # background. Files are decoded on a thread pool; poll() (called each loop, e.g. by
+    # PyGameApp.preload_assets) converts and processes the decoded images on the main thread,
+    # posting an AssetProgress game control event when loading starts (loaded=0) and per
+    # asset, and AssetsLoaded at the end.
+    # A manifest item is a filename or a dict of add() arguments, e.g.
+    #   {"filename": "ship.png", "scale_to": (40, 40)} or {"filename": "boom.png", "cols": 4, "rows": 4}
+    def __init__(self, manifest=None, workers=None):
+        self._items = []
+        self._pending = []
+        self._workers = workers
+        self._executor = None
+        self.loaded = 0
+        self.errors = []
+        if manifest is not None:
+            for item in manifest:
+                if isinstance(item, dict):
+                    self.add(**item)
+                else:
+                    self.add(item)
+
+    def add(self, filename, img_process=None, crop=None, scale_to=None, cols=None, rows=None):
+        # With cols and rows, filename is a spritesheet and its frames are sliced too
+        self._items.append({"filename": filename, "path": cdkkImage().image_path(filename),
+                            "img_process": img_process, "crop": crop, "scale_to": scale_to,
+                            "cols": cols, "rows": rows})
+
+    @property
+    def total(self):
+        return len(self._items)
+
+    @property
+    def progress(self):
+        return 1.0 if self.total == 0 else self.loaded / self.total
+
+    @property
+    def started(self):
+        return self._executor is not None
+
+    @property
+    def done(self):
+        return self.started and not self._pending
+
+    def _decode(path):
+        # Worker thread: decode only, as convert_alpha() needs the display
+        return pygame.image.load(path)
+
+    def start(self):
+        if not self.started:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers)
+            self._pending = [(item, self._executor.submit(AssetPreloader._decode, item["path"]))
+                             for item in self._items]
+            if not self._pending:
+                self._finished()
+            else:
+                EventManager.post_game_control("AssetProgress", loaded=0, total=self.total,
+                                               progress=0.0, filename=None)
+        return self
+
+    def _finish(self, item, future):
+        try:
+            surface = future.result()
+        except (pygame.error, OSError) as e:
+            logger.error("AssetPreloader: Can't load {0}: {1}".format(item["path"], e))
+            self.errors.append(item["filename"])
+            return
+        surface = surface.convert_alpha()
+        if item["cols"] is None:
+            img = cdkkImage()
+            img.surface = surface
+            img.process_list(item["img_process"], crop=item["crop"], scale=item["scale_to"])
+            asset_cache.put(asset_cache.key(item["path"], item["img_process"], item["crop"], item["scale_to"]), img.surface)
+        else:
+            asset_cache.put(asset_cache.key(item["path"]), surface)
+            frame_store.frames(item["path"], item["cols"], item["rows"], item["img_process"], item["crop"], item["scale_to"])
+
+    def _finished(self):
+        self._executor.shutdown(wait=False)
+        EventManager.post_game_control("AssetsLoaded", loaded=self.loaded, total=self.total, errors=self.errors)
+
+    def poll(self, max_msecs=None):
+        # Finish decoded assets, for up to max_msecs; returns True when everything is loaded
+        if not self.started:
+            self.start()
+        start = time.perf_counter()
+        while self._pending:
+            item, future = self._pending[0]
+            if not future.done():
+                break
+            self._pending.pop(0)
+            self._finish(item, future)
+            self.loaded += 1
+            EventManager.post_game_control("AssetProgress", loaded=self.loaded, total=self.total,
+                                           progress=self.progress, filename=item["filename"])
+            if not self._pending:
+                self._finished()
+            elif max_msecs is not None and (time.perf_counter() - start) * 1000 >= max_msecs:
+                break
+        return self.done
+
+    def wait(self):
+        # Load everything now, blocking
+        self.start()
+        while not self.poll():
+            self._pending[0][1].exception()  # Waits for the next decode
+        return self
+
+# --------------------------------------------------
+
+
+class RotationCache():
+    # Rotated copies of a surface at steps angles (360/steps degrees apart), made the first
+    # time each is needed, or all at once by prerender(). Sprites rotating the same source
+    # share the frames, and so their masks (see MaskCache). Sources least recently rotated
+    # are dropped when the frames take more than max_bytes. Frames are shared (see AssetCache).
+    def __init__(self, max_bytes=32*1024*1024):
+        self._rotations = OrderedDict()
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._rotations)
+
+    @property
+    def stats(self):
+        return {"sources": len(self._rotations), "bytes": self.bytes_used, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def _frames(self, source, steps, do_crop):
+        key = (source, steps, do_crop)
+        entry = self._rotations.get(key)
+        if entry is None:
+            entry = self._rotations[key] = {"frames": [None] * steps, "bytes": 0}
+        else:
+            self._rotations.move_to_end(key)
+        return entry
+
+    def _rotate(self, source, angle, do_crop):
+        # As cdkkImage.process("rotate"), but cropping with a subsurface rather than a copy
+        rotated = pygame.transform.rotate(source, angle)
+        if do_crop:
+            crop_x = int((rotated.get_width() - source.get_width())/2)
+            crop_y = int((rotated.get_height() - source.get_height())/2)
+            rotated = rotated.subsurface((crop_x, crop_y, rotated.get_width() - 2*crop_x, rotated.get_height() - 2*crop_y))
+        return asset_cache.share(rotated)
+
+    def get(self, source, angle, steps, do_crop=True):
+        # The cached frame nearest to angle (degrees anticlockwise)
+        entry = self._frames(source, steps, do_crop)
+        step = int(round(angle * steps / 360.0)) % steps
+        frame = entry["frames"][step]
+        if frame is None:
+            self.misses += 1
+            frame = entry["frames"][step] = self._rotate(source, step * 360.0 / steps, do_crop)
+            frame_bytes = AssetCache._surface_bytes(frame.get_parent() or frame)
+            entry["bytes"] += frame_bytes
+            self.bytes_used += frame_bytes
+            self.trim()
+        else:
+            self.hits += 1
+        return frame
+
+    def prerender(self, source, steps, do_crop=True):
+        return [self.get(source, i * 360.0 / steps, steps, do_crop) for i in range(steps)]
+
+    def trim(self):
+        # Drop the least recently used sources until within max_bytes, keeping the newest
+        while self.bytes_used > self.max_bytes and len(self._rotations) > 1:
+            key, entry = self._rotations.popitem(last=False)
+            self.bytes_used -= entry["bytes"]
+            self.evictions += 1
+
+    def clear(self):
+        self._rotations.clear()
+        self.bytes_used = 0
+        self.hits = self.misses = self.evictions = 0
+
+
+rotation_cache = RotationCache()
+
+# --------------------------------------------------
+
+
+class ImagePipeline():
+    # A compiled list of cdkkImage (command, value) steps. Compiling drops steps that do
+    # nothing and merges consecutive crops, scales and flips; crops are subsurfaces rather
+    # than copies. Results for shared (cached) sources are memoized per pipeline, and
+    # apply_many() processes e.g. a spritesheet's frames on a thread pool.
+    # Use ImagePipeline.compile(steps): pipelines are cached by their steps.
+    _pipelines = {}
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.memoize = all(c in ("crop", "scale", "flip", "stretch") for c, v in steps)
+        self._results = weakref.WeakKeyDictionary()
+
+    def __repr__(self):
+        return "<ImagePipeline {0}>".format(self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def compile(commands_values):
+        key = AssetCache._freeze(commands_values)
+        pipeline = ImagePipeline._pipelines.get(key)
+        if pipeline is None:
+            pipeline = ImagePipeline._pipelines[key] = ImagePipeline(ImagePipeline._merge(commands_values))
+        return pipeline
+
+    def _merge(commands_values):
+        steps = []
+        for command, value in commands_values:
+            if command is None or value is None:
+                continue
+            if command == "flip":
+                value = (bool(value[0]), bool(value[1]))
+                if value == (False, False):
+                    continue
+            elif command in ("crop", "stretch"):
+                value = tuple(value)
+                if value == (0, 0, 0, 0):
+                    continue
+            elif command == "scale":
+                value = tuple(value)
+            prev = steps[-1][0] if steps else None
+            if command == prev == "crop" and min(steps[-1][1]) >= 0 and min(value) >= 0:
+                # Negative margins pad the image, so crops are only merged without them
+                steps[-1] = ("crop", tuple(a + b for a, b in zip(steps[-1][1], value)))
+            elif command == prev == "scale":
+                steps[-1] = ("scale", value)
+            elif command == prev == "flip":
+                flip = (steps[-1][1][0] != value[0], steps[-1][1][1] != value[1])
+                if flip == (False, False):
+                    steps.pop()
+                else:
+                    steps[-1] = ("flip", flip)
+            else:
+                steps.append((command, value))
+        return steps
+
+    def _run(self, surface, image=None):
+        for command, value in self.steps:
+            if command == "crop" and min(value) >= 0 and value[0] + value[1] <= surface.get_width() \
+                    and value[2] + value[3] <= surface.get_height():
+                # value[left, right, top, bottom], inside the surface
+                w = surface.get_width() - value[0] - value[1]
+                h = surface.get_height() - value[2] - value[3]
+                surface = surface.subsurface((value[0], value[2], w, h))
+            elif command == "scale":
+                surface = pygame.transform.smoothscale(surface, value)
+            elif command == "flip":
+                surface = pygame.transform.flip(surface, value[0], value[1])
+            else:
+                # e.g. rotate and stretch
+                if image is None:
+                    image = cdkkImage()
+                image.surface = surface
+                image.process(command, value)
+                surface = image.surface
+        return surface
+
+    def apply(self, surface, image=None):
+        # The processed surface; image is the cdkkImage being processed, for "rotate"
+        if not self.steps or surface is None:
+            return surface
+        shared = self.memoize and asset_cache.is_shared(surface)
+        if shared and surface in self._results:
+            return self._results[surface]
+        return self._finish(surface, self._run(surface, image), shared)
+
+    def _finish(self, surface, result, shared):
+        if result.get_parent() is not None and not shared:
+            # Only a crop: copy, as the source may still be drawn on
+            result = result.copy()
+        elif shared and result.get_parent() is None:
+            # Not kept for subsurfaces, as they would keep the source alive
+            self._results[surface] = asset_cache.share(result)
+        return result
+
+    def apply_many(self, surfaces, workers=None):
+        # Process many surfaces, e.g. spritesheet frames, on a thread pool
+        surfaces = list(surfaces)
+        if len(surfaces) < 2 or not self.steps or not self.memoize:
+            return [self.apply(s) for s in surfaces]
+        shared = [asset_cache.is_shared(s) for s in surfaces]
+        results = [self._results.get(s) if sh else None for s, sh in zip(surfaces, shared)]
+        todo = [i for i, r in enumerate(results) if r is None]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for i, result in zip(todo, executor.map(self._run, [surfaces[i] for i in todo])):
+                # The memo is only updated here, on the calling thread
+                results[i] = self._finish(surfaces[i], result, shared[i])
+        return results
+
+# --------------------------------------------------
+
+
 class cdkkImage:
     imagePath = None
+    rotation_steps = None  # Use rotation_cache with this many angles for "rotate", instead of exact angles
 
     def __init__(self):
         super().__init__()
@@ -1197,6 +2809,7 @@ class cdkkImage:
         self._ss_cell_width = 0
         self._ss_cell_height = 0
         self._ss_img_process = None
+        self._ss_path = None
 
     @property
     def surface(self):
@@ -1212,27 +2825,38 @@ class cdkkImage:
         else:
             return os.path.join(self.imagePath, filename)
 
+    def make_writable(self):
+        # Copy the surface if it is shared with the asset cache, before drawing on it
+        if self._surface is not None and asset_cache.is_shared(self._surface):
+            self._surface = self._surface.copy()
+        return self._surface
+
     def create_copy(self, do_copy=True, info=None):
+        # A shared surface can't change, so it is kept rather than copied
         if do_copy:
-            self._surface_copy = self._surface.copy()
+            if asset_cache.is_shared(self._surface):
+                self._surface_copy = self._surface
+            else:
+                self._surface_copy = self._surface.copy()
             self._info_copy = info
 
     def restore_copy(self, do_restore=True):
         if do_restore and self._surface_copy is not None:
-            self._surface = self._surface_copy.copy()
+            if asset_cache.is_shared(self._surface_copy):
+                self._surface = self._surface_copy
+            else:
+                self._surface = self._surface_copy.copy()
         return self._info_copy
 
     def load(self, filename, img_process=None, crop=None, scale_to=None, set_copy=False):
-        self.surface = image = pygame.image.load(
-            self.image_path(filename)).convert_alpha()
-
-        self.process_list(img_process, crop=crop, scale=scale_to)
+        # The loaded surface is shared through asset_cache (see make_writable)
+        self.surface = asset_cache.load(self.image_path(filename), img_process, crop, scale_to)
         self.create_copy(set_copy)
         return self.surface
 
     def set_spritesheet(self, filename, cols, rows, img_process=None, crop=None, scale_to=None):
-        self._spritesheet = pygame.image.load(
-            self.image_path(filename)).convert_alpha()
+        self._ss_path = self.image_path(filename)
+        self._spritesheet = asset_cache.load(self._ss_path)
         self._ss_cols = cols
         self._ss_rows = rows
         ss_width = self._spritesheet.get_rect().width
@@ -1242,11 +2866,10 @@ class cdkkImage:
         self._ss_img_process = (img_process, crop, scale_to)
 
     def spritesheet_image(self, sprite_number):
-        x = self._ss_cell_width * (sprite_number % self._ss_cols)
-        y = self._ss_cell_height * (sprite_number // self._ss_cols)
-        rect = cdkkRect(x, y, self._ss_cell_width, self._ss_cell_height)
-        self.surface = self._spritesheet.subsurface(rect)
-        self.process_list(self._ss_img_process[0], crop=self._ss_img_process[1], scale=self._ss_img_process[2])
+        # The frame is shared through frame_store (see make_writable)
+        img_process, crop, scale_to = self._ss_img_process
+        self.surface = frame_store.frame(self._ss_path, self._ss_cols, self._ss_rows, sprite_number,
+                                         img_process, crop, scale_to)
         return self.surface
 
     def process(self, command, value):
@@ -1285,6 +2908,11 @@ class cdkkImage:
                 do_crop = True
                 do_restore = True
 
+            if self.rotation_steps and do_restore and self._surface_copy is not None:
+                # Nearest pre-rendered angle of the saved copy
+                self.surface = rotation_cache.get(self._surface_copy, value, self.rotation_steps, do_crop)
+                return self.surface.get_rect().size
+
             self.restore_copy(do_restore)
             size = self.surface.get_rect().size
             self.surface = pygame.transform.rotate(self.surface, value)
@@ -1304,7 +2932,8 @@ class cdkkImage:
 
         return self.surface.get_rect().size
 
-    def process_list(self, commands_values, **kwargs):
+    def process_steps(commands_values, **kwargs):
+        # (command, value) list: kwargs first, e.g. crop=..., scale=..., then commands_values
         cv_list = []
         for c, v in kwargs.items():
             cv_list.append((c,v))
@@ -1313,9 +2942,11 @@ class cdkkImage:
                 cv_list.extend(commands_values)
             else:
                 cv_list.append(commands_values)
+        return cv_list
 
-        for cv in cv_list:
-            self.process(cv[0], cv[1])
+    def process_list(self, commands_values, **kwargs):
+        cv_list = cdkkImage.process_steps(commands_values, **kwargs)
+        self.surface = ImagePipeline.compile(cv_list).apply(self.surface, self)
 
     def stretch_horiz(self, stretch_left, stretch_right):
         stretch_rect = self.surface.get_rect()
@@ -1362,6 +2993,143 @@ class cdkkImage:
 # --------------------------------------------------
 
 
+class NineSliceImage():
+    # An image for buttons, panels, pipes, etc that can be drawn at any size. The source is
+    # split once into 9 slices by margins[left, right, top, bottom]: corners keep their size,
+    # edges are stretched along their length and the centre both ways (as cdkkImage stretch,
+    # but with slices of any width). Recently rendered sizes are kept, up to max_sizes.
+    # Use NineSliceImage.shared(filename, margins) to share one between sprites.
+    _shared = {}
+
+    def __init__(self, image, margins, max_sizes=16):
+        if isinstance(image, str):
+            image = asset_cache.load(cdkkImage().image_path(image))
+        self.margins = tuple(margins)
+        self.max_sizes = max_sizes
+        self.hits = 0
+        self.misses = 0
+        self._renders = OrderedDict()
+        left, right, top, bottom = self.margins
+        w, h = image.get_size()
+        self._cols = ((0, left), (left, w - left - right), (w - right, right))
+        self._rows = ((0, top), (top, h - top - bottom), (h - bottom, bottom))
+        self._slices = [[image.subsurface((x, y, cw, rh)) for x, cw in self._cols] for y, rh in self._rows]
+
+    def __len__(self):
+        return len(self._renders)
+
+    def shared(filename, margins, max_sizes=16):
+        key = (filename, tuple(margins))
+        nine_slice = NineSliceImage._shared.get(key)
+        if nine_slice is None:
+            nine_slice = NineSliceImage._shared[key] = NineSliceImage(filename, margins, max_sizes)
+        return nine_slice
+
+    def render(self, size):
+        # The image at size; it is shared, so copy it before drawing on it
+        size = (int(size[0]), int(size[1]))
+        surface = self._renders.get(size)
+        if surface is not None:
+            self.hits += 1
+            self._renders.move_to_end(size)
+            return surface
+
+        self.misses += 1
+        left, right, top, bottom = self.margins
+        widths = (left, max(0, size[0] - left - right), right)
+        heights = (top, max(0, size[1] - top - bottom), bottom)
+        surface = pygame.Surface(size, pygame.SRCALPHA)
+        y = 0
+        for row, h in zip(self._slices, heights):
+            x = 0
+            for piece, w in zip(row, widths):
+                if w > 0 and h > 0 and piece.get_width() > 0 and piece.get_height() > 0:
+                    if piece.get_size() != (w, h):
+                        piece = pygame.transform.smoothscale(piece, (w, h))
+                    surface.blit(piece, (x, y))
+                x += w
+            y += h
+
+        self._renders[size] = asset_cache.share(surface)
+        while len(self._renders) > self.max_sizes:
+            self._renders.popitem(last=False)
+        return surface
+
+    def clear(self):
+        self._renders.clear()
+
+# --------------------------------------------------
+
+
+class FontCache():
+    # One pygame Font per (face, size), shared by every text sprite; face None is the default font.
+    # Fonts can't be used after pygame.font quits, so the cache is emptied then and generation
+    # goes up: fonts from before a quit/init cycle are never returned.
+    def __init__(self):
+        self._fonts = {}
+        self.generation = 0
+        self._quit_registered = False
+
+    def __len__(self):
+        return len(self._fonts)
+
+    def get(self, face, size):
+        if not pygame.font.get_init():
+            self.clear()
+        key = (self.generation, face, size)
+        font = self._fonts.get(key)
+        if font is None:
+            font = self._fonts[key] = pygame.font.Font(face, size)
+            if not self._quit_registered:
+                # Quit functions are called once, by the next pygame.quit()
+                pygame.register_quit(self.clear)
+                self._quit_registered = True
+        return font
+
+    def clear(self):
+        self._fonts.clear()
+        self.generation += 1
+        self._quit_registered = False
+
+
+font_cache = FontCache()
+
+
+class TextCache():
+    # Rendered text surfaces keyed by (font, text, colour, antialias), keeping the most
+    # recently used max_items. Surfaces are shared: blit them, don't draw on them.
+    def __init__(self, max_items=256):
+        self._renders = OrderedDict()
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._renders)
+
+    def render(self, font, text, colour, antialias=True):
+        key = (font, text, tuple(colour), antialias)
+        surface = self._renders.get(key)
+        if surface is None:
+            self.misses += 1
+            surface = self._renders[key] = asset_cache.share(font.render(text, antialias, colour))
+            while len(self._renders) > self.max_items:
+                self._renders.popitem(last=False)
+        else:
+            self.hits += 1
+            self._renders.move_to_end(key)
+        return surface
+
+    def clear(self):
+        self._renders.clear()
+        self.hits = self.misses = 0
+
+
+text_cache = TextCache()
+
+# --------------------------------------------------
+
+
 class StringLOL:
     # Multi-line string to list of lists of characters, with mirroring and mapping
     def __init__(self, ml_str, mirror_map=None):